@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Run every list_* and purge_* script against a synthetic account, and report what each one cost'''
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO)
+from flamethrower.readers import read_rows
+
+# Account sizes. large is roughly our biggest production account
+SIZES = {
+    'small': {'snapshots': 2000, 'amis': 200, 'instances': 100, 'elbs': 50, 'elbv2s': 50, 'rds_snapshots': 100},
+    'medium': {'snapshots': 20000, 'amis': 2000, 'instances': 500, 'elbs': 500, 'elbv2s': 500, 'rds_snapshots': 1000},
+    'large': {'snapshots': 200000, 'amis': 20000, 'instances': 2000, 'elbs': 5000, 'elbv2s': 5000, 'rds_snapshots': 5000},
+}
+
+# Each benchmark is (name, script, arguments, file whose rows it is measured by). {work} is the scratch directory.
+# The purge_* benchmarks read what the list_* ones wrote, so they run in this order. They --restart their
+# journals, so each run deletes everything again
+BENCHMARKS = [
+    ("list_snapshots", "purge_snapshots/list_snapshots_to_delete.py", ["--outfile", "{work}/snapshots.csv"], "{work}/snapshots.csv"),
+    ("list_rds_snapshots", "purge_snapshots/list_snapshots_to_delete.py", ["--type", "RDS", "--outfile", "{work}/rds-snapshots.csv"], "{work}/rds-snapshots.csv"),
+    ("list_amis", "purge_amis/list_amis_to_delete.py", ["--outfile", "{work}/amis.csv"], "{work}/amis.csv"),
+    ("list_instances", "purge_stopped_instances/list_instances_to_terminate.py", ["--outfile", "{work}/instances.csv"], "{work}/instances.csv"),
+    ("list_elbs", "purge_inactive_elbs/list_inactive_elbs.py", ["--outfile", "{work}/elbs.csv"], "{work}/elbs.csv"),
+    ("list_idle_elbs", "purge_inactive_elbs/list_inactive_elbs.py", ["--idle-days", "30", "--outfile", "{work}/idle-elbs.csv"], "{work}/idle-elbs.csv"),
+    ("list_all", "list_all/list_all.py", ["--outdir", "{work}/all"], "{work}/all/snapshots-to-delete.csv"),
+    ("purge_snapshots", "purge_snapshots/purge_snapshots.py",
+        ["--infile", "{work}/snapshots.csv", "--actually-do-it", "--restart", "--concurrent", "--deletes-per-second", "1000"], "{work}/snapshots.csv"),
+    ("purge_rds_snapshots", "purge_snapshots/purge_snapshots.py",
+        ["--infile", "{work}/rds-snapshots.csv", "--actually-do-it", "--restart", "--concurrent", "--deletes-per-second", "1000"], "{work}/rds-snapshots.csv"),
+    ("purge_amis", "purge_amis/purge_amis.py", ["--infile", "{work}/amis.csv", "--actually-do-it", "--restart"], "{work}/amis.csv"),
+    ("purge_stopped_instances", "purge_stopped_instances/purge_stopped_instances.py",
+        ["--infile", "{work}/instances.csv", "--actually-do-it", "--override-deletion-protection", "--max-in-flight", "50"], "{work}/instances.csv"),
+    ("purge_elbs", "purge_inactive_elbs/purge_elbs.py", ["--infile", "{work}/elbs.csv", "--actually-do-it", "--restart"], "{work}/elbs.csv"),
+]
+
+# What --baseline compares, and whether bigger is worse
+COMPARED = [("wall_seconds", True), ("api_calls", True), ("peak_rss_mb", True), ("rows_per_second", False)]
+
+
+def main(args, logger):
+    '''Executes the Primary Logic of the Fast Fix'''
+
+    account = dict(SIZES[args.size])
+    for kind in account:
+        if getattr(args, kind) is not None:
+            account[kind] = getattr(args, kind)
+    if args.regions:
+        from standin import REGIONS
+        account['regions'] = REGIONS[:args.regions]
+    logger.info(f"Benchmarking against {account} with {args.latency_ms}ms latency" +
+                (f" and {args.throttle_rate} calls/sec per service and region before throttling" if args.throttle_rate else "") +
+                f", and {args.pending_snapshots:.0%} of new snapshots pending for {args.pending_polls} polls")
+
+    work = args.workdir or tempfile.mkdtemp(prefix="flamethrower-bench-")
+    os.makedirs(work, exist_ok=True)
+    config_file = os.path.join(work, "account.json")
+    with open(config_file, "w") as f:
+        json.dump({'account': account, 'latency': args.latency_ms / 1000, 'throttle_rate': args.throttle_rate,
+                   'pending_share': args.pending_snapshots, 'pending_polls': args.pending_polls}, f)
+
+    results = {}
+    for name, script, script_args, rows_file in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        results[name] = run_benchmark(name, script, [a.format(work=work) for a in script_args], rows_file.format(work=work), config_file, work, logger)
+
+    print_table(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'account': account, 'latency_ms': args.latency_ms, 'throttle_rate': args.throttle_rate,
+                       'pending_snapshots': args.pending_snapshots, 'pending_polls': args.pending_polls, 'results': results}, f, indent=2)
+        logger.info(f"Wrote results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            logger.error(regression)
+        if regressions:
+            exit(1)
+        logger.info(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+    exit(0)
+
+
+def run_benchmark(name, script, script_args, rows_file, config_file, work, logger):
+    '''Run one script in its own process and return its result'''
+    stats_file = os.path.join(work, f"{name}.stats.json")
+    log_file = os.path.join(work, f"{name}.log")
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_script.py"),
+               "--account", config_file, "--stats", stats_file, os.path.join(REPO, script)] + script_args
+    logger.info(f"Running {name}, logging to {log_file}")
+
+    started = time.monotonic()
+    with open(log_file, "w") as log:
+        returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, cwd=work)
+    wall = time.monotonic() - started
+
+    if returncode != 0:
+        logger.error(f"{name} exited with {returncode}. See {log_file}")
+    with open(stats_file) as f:
+        stats = json.load(f)
+
+    rows = sum(1 for row in read_rows(rows_file)) if os.path.exists(rows_file) else 0
+    return({
+        'exit_code': returncode,
+        'wall_seconds': round(wall, 3),
+        'rows': rows,
+        'rows_per_second': round(rows / wall, 1) if wall else 0,
+        'api_calls': sum(a['calls'] for a in stats['api'].values()),
+        'throttled': sum(a['throttled'] for a in stats['api'].values()),
+        'peak_rss_mb': round(stats['peak_rss_mb'], 1),
+        'api': stats['api'],
+    })
+
+
+def print_table(results):
+    print(f"{'benchmark':<24} {'wall s':>9} {'rows':>8} {'rows/s':>9} {'api calls':>10} {'throttled':>10} {'peak MB':>8}")
+    for name, r in results.items():
+        print(f"{name:<24} {r['wall_seconds']:>9.2f} {r['rows']:>8} {r['rows_per_second']:>9.1f} {r['api_calls']:>10} {r['throttled']:>10} {r['peak_rss_mb']:>8.1f}"
+              + ("" if r['exit_code'] == 0 else f"  (exited {r['exit_code']})"))
+
+
+def compare(results, baseline, tolerance):
+    '''Return a message for every measurement that got more than tolerance worse than baseline'''
+    regressions = []
+    for name, r in results.items():
+        if r['exit_code'] != 0:
+            regressions.append(f"{name} exited with {r['exit_code']}")
+        if name not in baseline:
+            continue
+        for measure, bigger_is_worse in COMPARED:
+            was, now = baseline[name][measure], r[measure]
+            if not was:
+                continue
+            change = (now - was) / was
+            if (change if bigger_is_worse else -change) > tolerance:
+                regressions.append(f"{name} {measure} went from {was} to {now} ({change:+.0%})")
+    return(regressions)
+
+
+def do_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", help="print debugging info", action='store_true')
+    parser.add_argument("--error", help="print error info only", action='store_true')
+    parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
+    parser.add_argument("--size", help="How big an account to make", choices=list(SIZES), default="small")
+    parser.add_argument("--snapshots", help="Override the number of EBS snapshots", type=int)
+    parser.add_argument("--amis", help="Override the number of AMIs", type=int)
+    parser.add_argument("--instances", help="Override the number of stopped instances", type=int)
+    parser.add_argument("--elbs", help="Override the number of classic ELBs", type=int)
+    parser.add_argument("--elbv2s", help="Override the number of application and network load balancers", type=int)
+    parser.add_argument("--rds-snapshots", help="Override the number of RDS snapshots", type=int)
+    parser.add_argument("--regions", help="Only spread the account over the first N regions", type=int)
+    parser.add_argument("--latency-ms", help="Average time each API call takes", type=float, default=20)
+    parser.add_argument("--throttle-rate", help="Throttle each service in each region past this many calls a second (0 never throttles)", type=float, default=0)
+    parser.add_argument("--pending-snapshots", help="Share of the snapshots purge_stopped_instances.py takes that start out pending", type=float, default=0.25)
+    parser.add_argument("--pending-polls", help="How many times a pending snapshot is polled before it completes", type=int, default=3)
+    parser.add_argument("--only", help="Only run these benchmarks. The purge_* ones need their list_* one to have run in --workdir", nargs='+',
+                        choices=[b[0] for b in BENCHMARKS])
+    parser.add_argument("--workdir", help="Keep the inventories, logs and stats here (default: a new temp directory)")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against the results saved by an earlier --output, and exit 1 on a regression")
+    parser.add_argument("--tolerance", help="How much worse than --baseline counts as a regression", type=float, default=0.2)
+
+    args = parser.parse_args()
+
+    return(args)
+
+if __name__ == '__main__':
+
+    args = do_args()
+
+    # Logging idea stolen from: https://docs.python.org/3/howto/logging.html#configuring-logging
+    # create console handler and set level to debug
+    logger = logging.getLogger(sys.argv[0])
+    ch = logging.StreamHandler()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    elif args.error:
+        logger.setLevel(logging.ERROR)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # create formatter
+    if args.timestamp:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    else:
+        formatter = logging.Formatter('%(levelname)s - %(message)s')
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    # add ch to logger
+    logger.addHandler(ch)
+
+    try:
+        main(args, logger)
+    except KeyboardInterrupt:
+        exit(1)
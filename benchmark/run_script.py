@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Run one list_* or purge_* script against the synthetic account, and write what it cost to a JSON file
+
+run_benchmarks.py starts this in a fresh process for every script, so each one's peak RSS is its own.
+'''
+
+import json
+import os
+import resource
+import runpy
+import sys
+
+import botocore.session
+
+from standin import StandIn, SyntheticAccount
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower import snapshots
+
+# Snapshots pending in the stand-in finish after so many polls, not after so long, so there is no point waiting
+# minutes between polls like SnapshotPoller does for real ones. Its intervals are cut to this share of what they are
+POLL_TIME_SCALE = 0.01
+
+
+def install(standin):
+    '''Have every botocore client created from now on answered by standin'''
+    create_client = botocore.session.Session.create_client
+
+    def create_standin_client(self, *args, **kwargs):
+        client = create_client(self, *args, **kwargs)
+        standin.attach(client)
+        return(client)
+    botocore.session.Session.create_client = create_standin_client
+
+
+def peak_rss_mb():
+    '''Peak RSS of this process. Linux reports ru_maxrss in KB, macOS in bytes'''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return(maxrss / 1024 / 1024)
+    return(maxrss / 1024)
+
+
+def main(args):
+    with open(args.account) as f:
+        config = json.load(f)
+    standin = StandIn(SyntheticAccount(**config['account']), config['latency'], config['throttle_rate'],
+                      config.get('pending_share', 0.0), config.get('pending_polls', 3))
+    install(standin)
+    for name in ("MIN_POLL_INTERVAL", "MAX_POLL_INTERVAL", "SECONDS_PER_GB"):
+        setattr(snapshots, name, getattr(snapshots, name) * POLL_TIME_SCALE)
+
+    # The script runs as if it had been started itself, exit() and all
+    sys.argv = [args.script] + args.script_args
+    exit_code = 0
+    try:
+        runpy.run_path(args.script, run_name='__main__')
+    except SystemExit as e:
+        exit_code = e.code or 0
+
+    with open(args.stats, "w") as f:
+        json.dump({'exit_code': exit_code, 'peak_rss_mb': peak_rss_mb(), 'api': standin.stats()}, f, indent=2)
+    return(exit_code)
+
+
+def do_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--account", help="JSON file describing the synthetic account, written by run_benchmarks.py", required=True)
+    parser.add_argument("--stats", help="Write the run's API calls and peak RSS to this JSON file", required=True)
+    parser.add_argument("script", help="The list_* or purge_* script to run")
+    parser.add_argument("script_args", help="Arguments for the script", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    return(args)
+
+if __name__ == '__main__':
+
+    args = do_args()
+
+    # Nothing should ever reach AWS, but make sure there are no real credentials to reach it with
+    for var in ("AWS_PROFILE", "AWS_SESSION_TOKEN", "AWS_SECURITY_TOKEN"):
+        os.environ.pop(var, None)
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': "AKIABENCHMARK",
+        'AWS_SECRET_ACCESS_KEY': "benchmark",
+        'AWS_DEFAULT_REGION': "us-east-1",
+        'AWS_CONFIG_FILE': os.devnull,
+        'AWS_SHARED_CREDENTIALS_FILE': os.devnull,
+        'AWS_EC2_METADATA_DISABLED': "true",
+        # --cache-ttl and --regions-ttl default to ~/.flamethrower-cache.sqlite, so keep that in the work directory too
+        'HOME': os.getcwd(),
+    })
+
+    exit(main(args))
@@ -0,0 +1,569 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''A synthetic AWS account that answers botocore in-process, for benchmarking the scripts without touching AWS'''
+
+from base64 import b64encode
+from collections import Counter
+from urllib.parse import parse_qsl
+from xml.sax.saxutils import escape
+import datetime as dt
+import json
+import random
+import re
+import threading
+import time
+
+from botocore.awsrequest import AWSResponse
+
+# The regions every account has without opting in
+REGIONS = [
+    "us-east-1", "us-east-2", "us-west-1", "us-west-2", "ca-central-1", "sa-east-1",
+    "eu-west-1", "eu-west-2", "eu-west-3", "eu-central-1", "eu-north-1",
+    "ap-south-1", "ap-northeast-1", "ap-northeast-2", "ap-northeast-3", "ap-southeast-1", "ap-southeast-2",
+]
+
+# Opt-in regions the synthetic account has not opted into, so nothing should ever scan them
+NOT_OPTED_IN = ["af-south-1", "ap-east-1", "me-south-1", "eu-south-1"]
+
+ACCOUNT_ID = "123456789012"
+REQUEST_ID = "00000000-0000-0000-0000-000000000000"
+EPOCH = dt.datetime(2019, 1, 1, tzinfo=dt.timezone.utc)
+TEAMS = ["platform", "data", "web", "security"]
+
+# What each protocol calls being throttled
+THROTTLE_CODES = {"ec2": "RequestLimitExceeded", "query": "Throttling", "json": "Throttling"}
+
+
+class StandInError(Exception):
+    '''Answer the call with an AWS error instead of a response'''
+
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class SyntheticAccount(object):
+    '''An account with a fixed number of each resource, spread evenly over regions.
+
+    Nothing is stored. Every resource is built from its region and its index when it is asked for, so a 200k
+    snapshot account costs no more memory than an empty one. Resource IDs encode both, so a call naming a
+    resource can be answered without looking anything up. Deletes always succeed and change nothing.
+    '''
+
+    def __init__(self, snapshots=2000, amis=200, instances=100, elbs=50, elbv2s=50, rds_snapshots=100, regions=REGIONS, new_elbv2s=1):
+        self.totals = {
+            'snapshots': snapshots, 'amis': amis, 'instances': instances, 'elbs': elbs, 'elbv2s': elbv2s,
+            'rds_snapshots': rds_snapshots,
+        }
+        self.regions = list(regions)
+        # The last new_elbv2s load balancers in the first region were only just created
+        self.new_elbv2s = new_elbv2s
+        self.created = dt.datetime.now(dt.timezone.utc) - dt.timedelta(hours=1)
+
+    def count(self, kind, region):
+        '''How many of kind are in region. The remainder goes to the first regions'''
+        total, n_regions = self.totals[kind], len(self.regions)
+        r = self.regions.index(region)
+        return(total // n_regions + (1 if r < total % n_regions else 0))
+
+    def snapshot(self, region, n):
+        r = self.regions.index(region)
+        return({
+            'SnapshotId': resource_id("snap", r, n),
+            'VolumeId': resource_id("vol", r, n),
+            'VolumeSize': 8 + n % 100,
+            'State': "completed",
+            'Progress': "100%",
+            'StartTime': EPOCH + dt.timedelta(hours=n),
+            'Description': f"Synthetic snapshot {n}",
+            'OwnerId': ACCOUNT_ID,
+            'Encrypted': False,
+            'Tags': synthetic_tags("snapshot", n),
+        })
+
+    def image(self, region, n):
+        r = self.regions.index(region)
+        image = {
+            'ImageId': resource_id("ami", r, n),
+            'Name': f"bench-ami-{n}",
+            'CreationDate': (EPOCH + dt.timedelta(hours=n)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'PlatformDetails': "Linux/UNIX",
+            'State': "available",
+            'Description': f"Synthetic AMI {n}",
+            'OwnerId': ACCOUNT_ID,
+            'Tags': synthetic_tags("ami", n),
+            'BlockDeviceMappings': [],
+        }
+        # Each AMI is backed by the snapshot with the same index, as long as there are enough snapshots
+        if n < self.count('snapshots', region):
+            image['BlockDeviceMappings'].append({
+                'DeviceName': "/dev/xvda",
+                'Ebs': {'SnapshotId': resource_id("snap", r, n), 'VolumeSize': 8 + n % 100, 'VolumeType': "gp3"},
+            })
+        return(image)
+
+    def instance(self, region, n):
+        r = self.regions.index(region)
+        instance = {
+            'InstanceId': resource_id("i", r, n),
+            'InstanceType': "t3.micro",
+            'LaunchTime': EPOCH + dt.timedelta(hours=n),
+            'State': {'Code': 80, 'Name': "stopped"},
+            'StateTransitionReason': "User initiated (2020-01-11 22:52:15 GMT)",
+            'Tags': synthetic_tags("instance", n),
+        }
+        # Half the instances were launched from one of our AMIs, which keeps it out of the AMI worklist
+        amis = self.count('amis', region)
+        if amis and n % 2 == 0:
+            instance['ImageId'] = resource_id("ami", r, n % amis)
+        else:
+            instance['ImageId'] = "ami-0000000000000000f"
+        return(instance)
+
+    def termination_protection(self, instance_id):
+        return(decode_id(instance_id)[1] % 10 == 0)
+
+    def elb(self, region, n):
+        name = f"bench-elb-{n}"
+        elb = {
+            'LoadBalancerName': name,
+            'DNSName': f"{name}-{n}.{region}.elb.amazonaws.com",
+            'CanonicalHostedZoneName': f"{name}-{n}.{region}.elb.amazonaws.com",
+            'CreatedTime': EPOCH + dt.timedelta(hours=n),
+            'Scheme': "internet-facing",
+            'ListenerDescriptions': [{'Listener': {'Protocol': "HTTP", 'LoadBalancerPort': 80, 'InstancePort': 80}}],
+            'Instances': [],
+        }
+        # One in five still has something behind it
+        if n % 5 == 0:
+            elb['Instances'].append({'InstanceId': resource_id("i", self.regions.index(region), n)})
+        return(elb)
+
+    def is_new(self, region, n):
+        '''Whether elbv2 n was created an hour ago. It has a target registered, but no metrics yet'''
+        return(region == self.regions[0] and n >= self.count('elbv2s', region) - self.new_elbv2s)
+
+    def elbv2(self, region, n):
+        # Every other one is a network load balancer
+        kind = "application" if n % 2 == 0 else "network"
+        return({
+            'LoadBalancerArn': elbv2_arn(region, "loadbalancer", f"{kind[:3]}/bench-lb", n),
+            'LoadBalancerName': f"bench-lb-{n}",
+            'DNSName': f"bench-lb-{n}-{n:08x}.elb.{region}.amazonaws.com",
+            'CanonicalHostedZoneId': "Z35SXDOTRQ7X7K",
+            'CreatedTime': self.created if self.is_new(region, n) else EPOCH + dt.timedelta(hours=n),
+            'Scheme': "internet-facing",
+            'VpcId': "vpc-00000000000000001",
+            'State': {'Code': "active"},
+            'Type': kind,
+            'IpAddressType': "ipv4",
+        })
+
+    def target_group(self, region, n):
+        # Target group n is behind load balancer n, except one in ten, which is behind nothing
+        kind = "application" if n % 2 == 0 else "network"
+        return({
+            'TargetGroupArn': elbv2_arn(region, "targetgroup", "bench-tg", n),
+            'TargetGroupName': f"bench-tg-{n}",
+            'Protocol': "HTTP" if kind == "application" else "TCP",
+            'Port': 80,
+            'VpcId': "vpc-00000000000000001",
+            'TargetType': "instance",
+            'LoadBalancerArns': [] if n % 10 == 5 and not self.is_new(region, n) else [elbv2_arn(region, "loadbalancer", f"{kind[:3]}/bench-lb", n)],
+        })
+
+    def targets(self, region, n):
+        # One in five still has something behind it, as do the new ones
+        if n % 5 == 0 or self.is_new(region, n):
+            return([{'Target': {'Id': resource_id("i", self.regions.index(region), n), 'Port': 80},
+                     'TargetHealth': {'State': "healthy"}}])
+        return([])
+
+    def traffic(self, region, n, elbv2=True):
+        '''Requests (or bytes) a day through load balancer n. One in three has had none, and the new ones have
+        no datapoints at all yet, which is None'''
+        if elbv2 and self.is_new(region, n):
+            return(None)
+        return(0 if n % 3 == 0 else 1000)
+
+    def db_snapshot(self, region, n):
+        return({
+            'DBSnapshotIdentifier': f"bench-db-snapshot-{n}",
+            'DBInstanceIdentifier': f"bench-db-{n % 10}",
+            'SnapshotCreateTime': EPOCH + dt.timedelta(hours=n),
+            'AllocatedStorage': 20 + n % 100,
+            'Status': "available",
+            'SnapshotType': "manual",
+            'TagList': synthetic_tags("db-snapshot", n),
+        })
+
+
+def resource_id(prefix, region_index, n):
+    '''Make a 17 hex digit resource ID, the first two digits of which are the region'''
+    return(f"{prefix}-{region_index:02x}{n:015x}")
+
+
+def elbv2_arn(region, resource_type, name, n):
+    '''Make an elbv2 ARN that ends in n, as 16 hex digits'''
+    return(f"arn:aws:elasticloadbalancing:{region}:{ACCOUNT_ID}:{resource_type}/{name}-{n}/{n:016x}")
+
+
+def decode_arn(arn):
+    '''Return n from an ARN made by elbv2_arn()'''
+    return(int(arn.rsplit("/", 1)[1], 16))
+
+
+def decode_id(resource):
+    '''Return (region_index, n) from an ID made by resource_id()'''
+    digits = resource.split("-", 1)[1]
+    return(int(digits[:2], 16), int(digits[2:], 16))
+
+
+def synthetic_tags(kind, n):
+    return([{'Key': "Name", 'Value': f"bench-{kind}-{n}"}, {'Key': "team", 'Value': TEAMS[n % len(TEAMS)]}])
+
+
+class StandIn(object):
+    '''Answer every call a client makes from a SyntheticAccount, through botocore's before-send event.
+
+    The real request is still built and signed, and the answer is serialized to the wire format the service
+    uses and parsed by botocore, so the scripts pay for everything but the network. Each call sleeps for
+    around latency seconds, and with a throttle_rate each (service, region) only takes that many calls per
+    second before answering with the service's throttling error. Every call is counted.
+
+    pending_share of the snapshots made by create_snapshots start out pending, and stay pending for the first
+    pending_polls times describe_snapshots is asked about them. The rest are completed straight away.
+    '''
+
+    def __init__(self, account, latency=0.0, throttle_rate=0, pending_share=0.0, pending_polls=3, clock=time.monotonic):
+        self.account = account
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.pending_share = pending_share
+        self.pending_polls = pending_polls
+        self.clock = clock
+        self.calls = Counter()       # (service, operation, region) -> calls, including retries
+        self.throttled = Counter()   # (service, operation, region) -> calls answered with a throttling error
+        self.bytes = Counter()       # (service, operation, region) -> response bytes
+        self.buckets = {}            # (service, region) -> [tokens, last refill]
+        self.pending = {}            # SnapshotId -> times it has been described while pending
+        self.lock = threading.Lock()
+        self.handlers = {
+            ('ec2', 'DescribeRegions'): self.describe_regions,
+            ('ec2', 'DescribeSnapshots'): self.describe_snapshots,
+            ('ec2', 'DescribeImages'): self.describe_images,
+            ('ec2', 'DescribeInstances'): self.describe_instances,
+            ('ec2', 'DescribeInstanceAttribute'): self.describe_instance_attribute,
+            ('ec2', 'DescribeLaunchTemplateVersions'): lambda region, params: {'LaunchTemplateVersions': []},
+            ('ec2', 'CreateSnapshots'): self.create_snapshots,
+            ('ec2', 'DeleteSnapshot'): lambda region, params: {},
+            ('ec2', 'DeregisterImage'): lambda region, params: {},
+            ('ec2', 'TerminateInstances'): lambda region, params: {},
+            ('ec2', 'ModifyInstanceAttribute'): lambda region, params: {},
+            ('elb', 'DescribeLoadBalancers'): self.describe_load_balancers,
+            ('elb', 'DescribeTags'): self.describe_elb_tags,
+            ('elb', 'DeleteLoadBalancer'): lambda region, params: {},
+            ('elbv2', 'DescribeLoadBalancers'): self.describe_elbv2s,
+            ('elbv2', 'DescribeTargetGroups'): self.describe_target_groups,
+            ('elbv2', 'DescribeTargetHealth'): self.describe_target_health,
+            ('elbv2', 'DescribeTags'): self.describe_elbv2_tags,
+            ('elbv2', 'DeleteLoadBalancer'): lambda region, params: {},
+            ('cloudwatch', 'GetMetricData'): self.get_metric_data,
+            ('rds', 'DescribeDBSnapshots'): self.describe_db_snapshots,
+            ('rds', 'DeleteDBSnapshot'): lambda region, params: {},
+            ('sts', 'GetCallerIdentity'): lambda region, params: {'Account': ACCOUNT_ID, 'Arn': f"arn:aws:iam::{ACCOUNT_ID}:user/bench", 'UserId': "bench"},
+        }
+
+    def attach(self, client):
+        '''Answer client's calls from now on'''
+        client.meta.events.register('before-send', lambda request, event_name, **kwargs: self.send(client, request, event_name))
+
+    def send(self, client, request, event_name):
+        service_model = client.meta.service_model
+        operation_model = service_model.operation_model(event_name.rsplit(".", 1)[1])
+        service, region = service_model.service_name, client.meta.region_name
+        # Newer botocores pick one of the protocols a service speaks, like JSON instead of query for CloudWatch
+        protocol = getattr(service_model, "resolved_protocol", service_model.protocol)
+        key = (service, operation_model.name, region)
+        with self.lock:
+            self.calls[key] += 1
+
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+        try:
+            if not self.take_token(service, region):
+                with self.lock:
+                    self.throttled[key] += 1
+                raise StandInError(THROTTLE_CODES[protocol], "Rate exceeded", status=503)
+            handler = self.handlers.get((service, operation_model.name))
+            if handler is None:
+                raise StandInError("InvalidAction", f"The stand-in doesn't know {service} {operation_model.name}")
+            params = json.loads(request.body or "{}") if protocol == "json" else parse_params(request.body)
+            body = serialize_response(protocol, operation_model, handler(region, params))
+            status = 200
+            headers = {}
+        except StandInError as e:
+            body = serialize_error(protocol, e)
+            status = e.status
+            # CloudWatch moved from the query protocol to JSON, and still gives its error codes both ways
+            headers = {'x-amzn-query-error': f"{e.code};Sender"} if protocol == "json" else {}
+
+        body = body.encode()
+        with self.lock:
+            self.bytes[key] += len(body)
+        return(AWSResponse(request.url, status, headers, RawBody(body)))
+
+    def take_token(self, service, region):
+        '''Return False if (service, region) has used up its throttle_rate calls for now'''
+        if not self.throttle_rate:
+            return(True)
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.setdefault((service, region), [self.throttle_rate, now])
+            bucket[0] = min(self.throttle_rate, bucket[0] + (now - bucket[1]) * self.throttle_rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return(False)
+            bucket[0] -= 1
+            return(True)
+
+    def stats(self):
+        '''Return the counts as a JSON friendly dict keyed by "service.Operation"'''
+        output = {}
+        for (service, operation, region), calls in self.calls.items():
+            entry = output.setdefault(f"{service}.{operation}", {'calls': 0, 'throttled': 0, 'bytes': 0})
+            entry['calls'] += calls
+            entry['throttled'] += self.throttled[(service, operation, region)]
+            entry['bytes'] += self.bytes[(service, operation, region)]
+        return(output)
+
+    def describe_regions(self, region, params):
+        regions = [(r, "opt-in-not-required") for r in self.account.regions]
+        # Like a real account, there are opt-in regions it never opted into. AWS only lists them with AllRegions
+        if params.get('AllRegions') == "true":
+            regions += [(r, "not-opted-in") for r in NOT_OPTED_IN]
+        statuses = param_filters(params).get('opt-in-status')
+        return({'Regions': [{'RegionName': r, 'Endpoint': f"ec2.{r}.amazonaws.com", 'OptInStatus': status}
+                            for r, status in regions if not statuses or status in statuses]})
+
+    def describe_snapshots(self, region, params):
+        snapshot_ids = param_list(params, "SnapshotId")
+        if snapshot_ids:
+            return({'Snapshots': [self.progress(self.account.snapshot(region, decode_id(s)[1])) for s in snapshot_ids]})
+        items, token = page(lambda n: self.account.snapshot(region, n), self.account.count('snapshots', region), params, 'MaxResults', 'NextToken', 1000)
+        return({'Snapshots': items, 'NextToken': token})
+
+    def describe_images(self, region, params):
+        image_ids = param_filters(params).get('image-id')
+        if image_ids:
+            r = self.account.regions.index(region)
+            found = [decode_id(i) for i in image_ids]
+            return({'Images': [self.account.image(region, n) for (ir, n) in found if ir == r and n < self.account.count('amis', region)]})
+        items, token = page(lambda n: self.account.image(region, n), self.account.count('amis', region), params, 'MaxResults', 'NextToken', 1000)
+        return({'Images': items, 'NextToken': token})
+
+    def describe_instances(self, region, params):
+        items, token = page(lambda n: self.account.instance(region, n), self.account.count('instances', region), params, 'MaxResults', 'NextToken', 1000)
+        return({'Reservations': [{'ReservationId': f"r-{i['InstanceId'][2:]}", 'Instances': [i]} for i in items], 'NextToken': token})
+
+    def describe_instance_attribute(self, region, params):
+        instance_id = params['InstanceId']
+        return({'InstanceId': instance_id, 'DisableApiTermination': {'Value': self.account.termination_protection(instance_id)}})
+
+    def create_snapshots(self, region, params):
+        r, n = decode_id(params['InstanceSpecification.InstanceId'])
+        snapshot = self.account.snapshot(region, n)
+        # Spread the pending ones evenly, so every region has its share
+        if int((n + 1) * self.pending_share) > int(n * self.pending_share):
+            with self.lock:
+                self.pending[snapshot['SnapshotId']] = 0
+            snapshot = self.progress(snapshot)
+        return({'Snapshots': [{k: snapshot[k] for k in ('SnapshotId', 'VolumeId', 'VolumeSize', 'State', 'Progress', 'StartTime')}]})
+
+    def progress(self, snapshot):
+        '''Return snapshot as it stands now. A pending one gets further along each time it is described'''
+        with self.lock:
+            if snapshot['SnapshotId'] not in self.pending:
+                return(snapshot)
+            polls = self.pending[snapshot['SnapshotId']]
+            if polls > self.pending_polls:
+                del self.pending[snapshot['SnapshotId']]
+                return(snapshot)
+            self.pending[snapshot['SnapshotId']] = polls + 1
+        return(dict(snapshot, State="pending", Progress=f"{100 * polls // (self.pending_polls + 1)}%"))
+
+    def describe_load_balancers(self, region, params):
+        items, token = page(lambda n: self.account.elb(region, n), self.account.count('elbs', region), params, 'PageSize', 'Marker', 400)
+        return({'LoadBalancerDescriptions': items, 'NextMarker': token})
+
+    def describe_elb_tags(self, region, params):
+        names = param_list(params, "LoadBalancerNames")
+        return({'TagDescriptions': [{'LoadBalancerName': name, 'Tags': synthetic_tags("elb", int(name.rsplit("-", 1)[1]))} for name in names]})
+
+    def describe_elbv2s(self, region, params):
+        items, token = page(lambda n: self.account.elbv2(region, n), self.account.count('elbv2s', region), params, 'PageSize', 'Marker', 400)
+        return({'LoadBalancers': items, 'NextMarker': token})
+
+    def describe_target_groups(self, region, params):
+        items, token = page(lambda n: self.account.target_group(region, n), self.account.count('elbv2s', region), params, 'PageSize', 'Marker', 400)
+        return({'TargetGroups': items, 'NextMarker': token})
+
+    def describe_target_health(self, region, params):
+        return({'TargetHealthDescriptions': self.account.targets(region, decode_arn(params['TargetGroupArn']))})
+
+    def describe_elbv2_tags(self, region, params):
+        arns = param_list(params, "ResourceArns")
+        return({'TagDescriptions': [{'ResourceArn': arn, 'Tags': synthetic_tags("lb", decode_arn(arn))} for arn in arns]})
+
+    def get_metric_data(self, region, params):
+        start, end = as_datetime(params['StartTime']), as_datetime(params['EndTime'])
+        seconds = int((end - start).total_seconds())
+        results = []
+        for query in params['MetricDataQueries']:
+            stat = query['MetricStat']
+            dimension = stat['Metric']['Dimensions'][0]
+            # Classic ELBs go by name, like bench-elb-7, and the rest by the end of the ARN, like app/bench-lb-7/0000000000000007
+            if dimension['Name'] == "LoadBalancerName":
+                traffic = self.account.traffic(region, int(dimension['Value'].rsplit("-", 1)[1]), elbv2=False)
+            else:
+                traffic = self.account.traffic(region, decode_arn(dimension['Value']))
+            # Idle load balancers still publish a datapoint a day, of 0
+            count = seconds // int(stat['Period']) if traffic is not None else 0
+            results.append({
+                'Id': query['Id'],
+                'Label': stat['Metric']['MetricName'],
+                'Timestamps': [start + dt.timedelta(seconds=int(stat['Period']) * i) for i in range(count)],
+                'Values': [float(traffic or 0)] * count,
+                'StatusCode': "Complete",
+            })
+        return({'MetricDataResults': results})
+
+    def describe_db_snapshots(self, region, params):
+        items, token = page(lambda n: self.account.db_snapshot(region, n), self.account.count('rds_snapshots', region), params, 'MaxRecords', 'Marker', 100)
+        return({'DBSnapshots': items, 'Marker': token})
+
+
+def page(item_fn, total, params, size_key, token_key, default_size):
+    '''Return (items, token) for the page of total items that params asks for. The token is just an offset'''
+    start = int(params.get(token_key) or 0)
+    end = min(total, start + int(params.get(size_key) or default_size))
+    return([item_fn(n) for n in range(start, end)], str(end) if end < total else None)
+
+
+def parse_params(body):
+    '''Return the form encoded parameters of an EC2 or Query protocol request as a flat dict'''
+    if isinstance(body, bytes):
+        body = body.decode()
+    return(dict(parse_qsl(body or "", keep_blank_values=True)))
+
+
+def param_list(params, name):
+    '''Return the values of a list parameter, sent as Name.N by EC2 or Name.member.N by everything else'''
+    pattern = re.compile(rf"^{re.escape(name)}\.(?:member\.)?(\d+)$")
+    found = sorted((int(m.group(1)), v) for k, v in params.items() for m in [pattern.match(k)] if m)
+    return([v for i, v in found])
+
+
+def param_filters(params):
+    '''Return EC2 Filters as {name: [values]}'''
+    filters = {}
+    for key, name in params.items():
+        m = re.match(r"^Filter\.(\d+)\.Name$", key)
+        if m:
+            filters[name] = param_list(params, f"Filter.{m.group(1)}.Value")
+    return(filters)
+
+
+class RawBody(object):
+    '''The raw stream an AWSResponse reads its content from'''
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield(self.body)
+
+
+def as_datetime(value):
+    '''Return a timestamp parameter, sent as epoch seconds by JSON or ISO 8601 by query, as a datetime'''
+    if isinstance(value, (int, float)):
+        return(dt.datetime.fromtimestamp(value, dt.timezone.utc))
+    return(dt.datetime.fromisoformat(value.replace("Z", "+00:00")))
+
+
+def serialize_response(protocol, operation_model, data):
+    '''Render data as the XML (or JSON) body botocore expects back from operation_model'''
+    shape = operation_model.output_shape
+    if protocol == "json":
+        return(json.dumps(data, default=lambda value: value.timestamp()))
+    body = xml_members(shape, data) if shape is not None else ""
+    name = operation_model.name
+    if protocol == "ec2":
+        return(f'<?xml version="1.0" encoding="UTF-8"?>\n<{name}Response><requestId>{REQUEST_ID}</requestId>{body}</{name}Response>')
+    wrapper = shape.serialization.get('resultWrapper') if shape is not None else None
+    if wrapper:
+        body = f"<{wrapper}>{body}</{wrapper}>"
+    return(f'<?xml version="1.0" encoding="UTF-8"?>\n<{name}Response>{body}'
+           f'<ResponseMetadata><RequestId>{REQUEST_ID}</RequestId></ResponseMetadata></{name}Response>')
+
+
+def serialize_error(protocol, error):
+    if protocol == "json":
+        return(json.dumps({'__type': error.code, 'message': error.message}))
+    code, message = escape(error.code), escape(error.message)
+    if protocol == "ec2":
+        return(f'<?xml version="1.0" encoding="UTF-8"?>\n<Response><Errors><Error><Code>{code}</Code><Message>{message}</Message>'
+               f'</Error></Errors><RequestID>{REQUEST_ID}</RequestID></Response>')
+    return(f'<?xml version="1.0" encoding="UTF-8"?>\n<ErrorResponse><Error><Type>Sender</Type><Code>{code}</Code>'
+           f'<Message>{message}</Message></Error><RequestId>{REQUEST_ID}</RequestId></ErrorResponse>')
+
+
+def xml_members(shape, data):
+    '''Render the members of a structure shape that are set in data'''
+    output = []
+    for name, member in shape.members.items():
+        value = data.get(name)
+        if value is None:
+            continue
+        tag = member.serialization.get('name', name)
+        if member.type_name == "list" and member.serialization.get('flattened'):
+            item_tag = member.member.serialization.get('name', tag)
+            output.extend(f"<{item_tag}>{xml_value(member.member, v)}</{item_tag}>" for v in value)
+        else:
+            output.append(f"<{tag}>{xml_value(member, value)}</{tag}>")
+    return("".join(output))
+
+
+def xml_value(shape, value):
+    if shape.type_name == "structure":
+        return(xml_members(shape, value))
+    if shape.type_name == "list":
+        item_tag = shape.member.serialization.get('name', "member")
+        return("".join(f"<{item_tag}>{xml_value(shape.member, v)}</{item_tag}>" for v in value))
+    if shape.type_name == "map":
+        key_tag = shape.key.serialization.get('name', "key")
+        value_tag = shape.value.serialization.get('name', "value")
+        return("".join(f"<entry><{key_tag}>{xml_value(shape.key, k)}</{key_tag}><{value_tag}>{xml_value(shape.value, v)}</{value_tag}></entry>"
+                       for k, v in value.items()))
+    if shape.type_name == "timestamp" and isinstance(value, dt.datetime):
+        return(value.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+    if shape.type_name == "boolean":
+        return("true" if value else "false")
+    if shape.type_name == "blob":
+        return(b64encode(value).decode())
+    return(escape(str(value)))
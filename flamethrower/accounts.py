@@ -0,0 +1,271 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Run the scripts across many accounts by assuming a role in each one'''
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from queue import Empty
+import boto3
+import botocore.session
+from botocore.credentials import AssumeRoleCredentialFetcher, DeferredRefreshableCredentials
+from botocore.exceptions import BotoCoreError, ClientError
+import logging
+import multiprocessing
+import sys
+import traceback
+import weakref
+
+from flamethrower.metrics import metrics
+from flamethrower.throttle import controller
+
+# The role AWS Organizations creates in every account it creates
+DEFAULT_ROLE_NAME = "OrganizationAccountAccessRole"
+
+# Each process still scans up to --max-workers regions at once
+DEFAULT_MAX_PROCESSES = 4
+
+# Worker processes send their rows back this many at a time, and get this many batches ahead of what has been
+# written before they wait, so no more than a few thousand rows per account are ever in memory
+ROW_BATCH_SIZE = 500
+ACCOUNT_QUEUE_SIZE = 8
+
+# The account each assume_role_session() session is in, so its clients can be told apart from other accounts'
+_assumed_accounts = weakref.WeakKeyDictionary()
+
+
+def assume_role_session(session, account_id, role_name=DEFAULT_ROLE_NAME, sts_client=None):
+    '''Return a boto3 Session for role_name in account_id, assumed with session's credentials.
+
+    AssumeRole credentials only last an hour, and a purge across a big account can take longer, so the role is
+    assumed on the first call and assumed again shortly before each set of credentials expires.
+
+    sts_client defaults to one made from session, so AWS_ENDPOINT_URL_STS can point it at a local STS
+    '''
+    if sts_client is None:
+        client_creator = session._session.create_client
+    else:
+        client_creator = lambda *args, **kwargs: sts_client
+    fetcher = AssumeRoleCredentialFetcher(
+        client_creator=client_creator,
+        source_credentials=session.get_credentials(),
+        role_arn=f"arn:aws:iam::{account_id}:role/{role_name}",
+        extra_args={'RoleSessionName': "aws-flamethrower-scripts"}
+    )
+    botocore_session = botocore.session.Session()
+    botocore_session._credentials = DeferredRefreshableCredentials(
+        refresh_using=fetcher.fetch_credentials,
+        method="assume-role"
+    )
+    if session.region_name:
+        botocore_session.set_config_variable('region', session.region_name)
+    assumed = boto3.Session(botocore_session=botocore_session)
+    _assumed_accounts[assumed] = account_id
+    return(assumed)
+
+
+def session_account(session):
+    '''Return the account_id session was assumed into by assume_role_session, or None for any other session'''
+    return(_assumed_accounts.get(session))
+
+
+def account_session(profile=None, account_id=None, role_name=DEFAULT_ROLE_NAME):
+    '''Return a Session for --profile (or the normal credentials), in account_id if one is given'''
+    if profile:
+        session = boto3.Session(profile_name=profile)
+    else:
+        session = boto3.Session()
+    if account_id is None:
+        return(session)
+    return(assume_role_session(session, account_id, role_name))
+
+
+def worker_logger(args):
+    '''Return the script's logger, set up from --debug, --error and --timestamp if this process hasn't done it.
+
+    The scripts set their logger up under if __name__ == '__main__', which a spawned or forkserver worker
+    process never runs, so anything that can run in an --accounts worker gets its logger from here
+    '''
+    logger = logging.getLogger(sys.argv[0])
+    if logger.handlers:
+        return(logger)
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    elif args.error:
+        logger.setLevel(logging.ERROR)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # Silence Boto3 & Friends
+    logging.getLogger('botocore').setLevel(logging.WARNING)
+    logging.getLogger('boto3').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+    ch = logging.StreamHandler()
+    if args.timestamp:
+        ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    else:
+        ch.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+    logger.addHandler(ch)
+    return(logger)
+
+
+def read_account_ids(accounts=None, accounts_file=None):
+    '''Return the account IDs from --accounts and --accounts-file, once each, in the order given'''
+    account_ids = list(accounts or [])
+    if accounts_file:
+        with open(accounts_file) as f:
+            for line in f:
+                # One per line. Blank lines and # comments are skipped
+                line = line.split("#")[0].strip()
+                if line:
+                    account_ids.append(line)
+    return(list(dict.fromkeys(account_ids)))
+
+
+def scan_accounts(account_ids, scan_fn, max_processes=DEFAULT_MAX_PROCESSES, logger=None):
+    '''Call scan_fn(account_id) for every account and yield (account_id, [(region, rows), ...]) in the order given.
+
+    scan_fn returns (region, rows) pairs like scan_regions() does. With a single account or process they are
+    handed straight back. Otherwise accounts are scanned on up to max_processes processes, so scan_fn must be
+    picklable (a module level function, or a partial of one). Each one's rows stream back in batches through a
+    bounded queue, and what its API calls, phases and throttling cost is added to this process's once it is done.
+
+    An account whose scan fails with an AWS error, like AccessDenied assuming the role, is logged and skipped,
+    keeping whatever rows it had already given, so one bad account doesn't lose all the others
+    '''
+    logger = logger or logging.getLogger(sys.argv[0])
+    max_processes = int(max_processes)
+    if max_processes <= 1 or len(account_ids) <= 1:
+        for account_id in account_ids:
+            if account_id is None:
+                yield(account_id, scan_fn(account_id))
+            else:
+                yield(account_id, guarded(account_id, scan_fn, logger))
+        return
+
+    # The manager has to go before the pool, so workers still blocked on a full queue are let go
+    with ProcessPoolExecutor(max_workers=min(max_processes, len(account_ids))) as executor, multiprocessing.Manager() as manager:
+        queues = [manager.Queue(maxsize=ACCOUNT_QUEUE_SIZE) for account_id in account_ids]
+        futures = [executor.submit(drain_account, scan_fn, account_id, q) for account_id, q in zip(account_ids, queues)]
+        try:
+            for account_id, q, future in zip(account_ids, queues, futures):
+                yield(account_id, received(account_id, q, future, logger))
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def guarded(account_id, scan_fn, logger):
+    '''Yield scan_fn(account_id)'s (region, rows), stopping with an error logged if the scan fails with an AWS error'''
+    failed = []
+
+    def guarded_rows(rows):
+        try:
+            yield from rows
+        except (BotoCoreError, ClientError) as e:
+            failed.append(e)
+
+    try:
+        for region, rows in scan_fn(account_id):
+            yield(region, guarded_rows(rows))
+            if failed:
+                raise failed[0]
+    except (BotoCoreError, ClientError) as e:
+        logger.error(f"Unable to scan account {account_id}, skipping the rest of it - {e}")
+
+
+def received(account_id, q, future, logger):
+    '''Yield (region, rows) as drain_account() sends them back for account_id through q'''
+    pending = []
+
+    def next_message():
+        return(pending.pop() if pending else receive(q, future))
+
+    def region_rows():
+        # Up to the next message that isn't rows, which is left for received() to pick up
+        while True:
+            kind, value = next_message()
+            if kind != "rows":
+                pending.append((kind, value))
+                return
+            yield from value
+
+    rows = None
+    while True:
+        # The rows come through the same queue as everything else, so any the caller left have to be used up first
+        for row in rows or []:
+            pass
+        kind, value = next_message()
+        if kind == "region":
+            rows = region_rows()
+            yield(value, rows)
+            continue
+        detail, recorded, throttled = value
+        metrics.merge(recorded)
+        controller.merge(throttled)
+        if kind == "failed":
+            logger.error(f"Unable to scan account {account_id}, skipping the rest of it - {detail}")
+        elif kind == "error":
+            raise RuntimeError(f"Scanning account {account_id} failed\n{detail}")
+        return
+
+
+def receive(q, future):
+    '''Return the next message on q, counting the time spent waiting for it as the waiting phase.
+
+    If the worker died without saying it was done, its exception is raised instead of waiting forever
+    '''
+    try:
+        return(q.get_nowait())
+    except Empty:
+        pass
+    with metrics.phase("waiting"):
+        while True:
+            try:
+                return(q.get(timeout=1))
+            except Empty:
+                if not future.done():
+                    continue
+            try:
+                return(q.get_nowait())
+            except Empty:
+                future.result()
+                raise RuntimeError("A worker process finished without sending back all its results")
+
+
+def drain_account(scan_fn, account_id, q):
+    '''Run scan_fn(account_id) in a worker process, sending each region's rows back through q in batches.
+
+    The last message says how it ended, with what its API calls, phases and throttling cost. An AWS error is
+    "failed" with the error, and anything else is "error" with its traceback, so the parent can carry on or not
+    '''
+    # A worker process is reused for other accounts, and may have been forked with the parent's metrics
+    metrics.reset()
+    controller.reset()
+    kind, detail = "done", None
+    try:
+        for region, rows in scan_fn(account_id):
+            q.put(("region", region))
+            rows = iter(rows)
+            while True:
+                batch = list(islice(rows, ROW_BATCH_SIZE))
+                if not batch:
+                    break
+                q.put(("rows", batch))
+    except (BotoCoreError, ClientError) as e:
+        kind, detail = "failed", str(e)
+    except Exception:
+        kind, detail = "error", traceback.format_exc()
+    q.put((kind, (detail, metrics.export(), controller.export())))
@@ -0,0 +1,251 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Keep raw describe results on disk so back to back list_* runs don't re-describe the whole account'''
+
+import base64
+import datetime as dt
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_FILE = os.path.expanduser("~/.flamethrower-cache.sqlite")
+
+# Only calls that just read what is in the account are ever answered from the cache. get_ calls like
+# get_metric_data ask for a time window that moves on every run, so caching them would only fill the file
+CACHED_PREFIXES = ("describe_", "list_")
+
+# Which account an access key belongs to never changes, but temporary keys are replaced all the time, so they are
+# only remembered for a day. Older ones are deleted, so the file doesn't keep every key ever used
+ACCESS_KEY_TTL = 86400
+
+# Bumped whenever a table changes shape. Files written by an older version have their tables dropped and start over
+SCHEMA_VERSION = 2
+OLD_TABLES = ["accounts", "inventory", "pages"]
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS access_keys (access_key TEXT PRIMARY KEY, account_id TEXT NOT NULL, seen_at REAL NOT NULL)",
+    '''CREATE TABLE IF NOT EXISTS inventory (
+        account_id TEXT, region TEXT, service TEXT, api TEXT, params TEXT, fetched_at REAL NOT NULL,
+        PRIMARY KEY (account_id, region, service, api, params)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS pages (
+        account_id TEXT, region TEXT, service TEXT, api TEXT, params TEXT, seq INTEGER, body TEXT NOT NULL,
+        PRIMARY KEY (account_id, region, service, api, params, seq)
+    )''',
+]
+
+
+def create_schema(db):
+    '''Create the tables in db, dropping any left by an older version of this file.
+
+    This takes the write lock first, so --accounts workers opening the same file can't drop each other's tables
+    '''
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            for table in OLD_TABLES:
+                db.execute(f"DROP TABLE IF EXISTS {table}")
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        for statement in SCHEMA:
+            db.execute(statement)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def encode_page(page):
+    '''Return page, a parsed botocore response, as JSON. Timestamps and blobs are tagged so decode_page can restore them'''
+    return(json.dumps(page, default=encode_value))
+
+
+def encode_value(value):
+    if isinstance(value, dt.datetime):
+        return({"__datetime__": value.isoformat()})
+    if isinstance(value, bytes):
+        return({"__bytes__": base64.b64encode(value).decode("ascii")})
+    raise TypeError(f"{type(value).__name__} can't be kept in the inventory cache")
+
+
+def decode_page(body):
+    '''Return the page encode_page turned into body. Unlike unpickling, this can't run anything found in the file'''
+    return(json.loads(body, object_hook=decode_value))
+
+
+def decode_value(obj):
+    if len(obj) == 1:
+        if "__datetime__" in obj:
+            return(dt.datetime.fromisoformat(obj["__datetime__"]))
+        if "__bytes__" in obj:
+            return(base64.b64decode(obj["__bytes__"]))
+    return(obj)
+
+
+class InventoryCache(object):
+    '''A SQLite file of describe responses, keyed by (account, region, service, api, params), that go stale after ttl seconds.
+
+    Every thread gets its own connection, so the region scan workers can all read and write at once.
+    '''
+
+    def __init__(self, path, ttl, account_id, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.account_id = account_id
+        self.clock = clock
+        self.local = threading.local()
+        create_schema(self.db())
+        self.prune()
+
+    def prune(self):
+        '''Delete everything older than the ttl, so the file doesn't keep growing with answers nobody can use'''
+        db = self.db()
+        cutoff = self.clock() - self.ttl
+        with db:
+            db.execute(
+                "DELETE FROM pages WHERE (account_id, region, service, api, params) IN "
+                "(SELECT account_id, region, service, api, params FROM inventory WHERE fetched_at < ?)", (cutoff,))
+            db.execute("DELETE FROM inventory WHERE fetched_at < ?", (cutoff,))
+
+    def db(self):
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.path, timeout=60)
+            self.local.db.execute("PRAGMA journal_mode=WAL")
+        return(self.local.db)
+
+    def key(self, client, api, params):
+        '''Return the cache key for calling api on client with params.
+
+        PaginationConfig doesn't change the answer, and an empty Filters list is the same as not passing one
+        '''
+        params = {k: v for k, v in params.items() if k != "PaginationConfig" and v != []}
+        return((self.account_id, client.meta.region_name, client.meta.service_model.service_name, api,
+                json.dumps(params, sort_keys=True, default=str)))
+
+    def get(self, key):
+        '''Yield the pages stored for key, or return None if there are none younger than the ttl'''
+        row = self.db().execute(
+            "SELECT fetched_at FROM inventory WHERE account_id=? AND region=? AND service=? AND api=? AND params=?", key).fetchone()
+        if row is None or row[0] < self.clock() - self.ttl:
+            return(None)
+        cursor = self.db().execute(
+            "SELECT body FROM pages WHERE account_id=? AND region=? AND service=? AND api=? AND params=? ORDER BY seq", key)
+        return(decode_page(body) for (body,) in cursor)
+
+    def put(self, key, bodies):
+        '''Replace the pages stored for key with bodies, a list of pages already passed through encode_page'''
+        db = self.db()
+        with db:
+            db.execute("DELETE FROM pages WHERE account_id=? AND region=? AND service=? AND api=? AND params=?", key)
+            db.executemany("INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)", [key + (seq, body) for seq, body in enumerate(bodies)])
+            db.execute("INSERT OR REPLACE INTO inventory VALUES (?, ?, ?, ?, ?, ?)", key + (self.clock(),))
+
+    def wrap(self, client):
+        '''Return client with its describe and list calls, and their paginators, answered from the cache'''
+        return(CachedClient(self, client))
+
+
+class CachedClient(object):
+    '''Stands in for a boto3 client. Read calls go through the cache, everything else straight to the client'''
+
+    def __init__(self, cache, client):
+        self._cache = cache
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not name.startswith(CACHED_PREFIXES) or name == "get_paginator" or not callable(attr):
+            return(attr)
+
+        def call(**kwargs):
+            key = self._cache.key(self._client, name, kwargs)
+            pages = self._cache.get(key)
+            if pages is not None:
+                return(next(pages))
+            response = attr(**kwargs)
+            self._cache.put(key, [encode_page(response)])
+            return(response)
+        return(call)
+
+    def get_paginator(self, api):
+        if not api.startswith(CACHED_PREFIXES):
+            return(self._client.get_paginator(api))
+        return(CachedPaginator(self._cache, self._client, api))
+
+
+class CachedPaginator(object):
+    '''Stands in for a boto3 paginator, replaying every page of a cached pagination'''
+
+    def __init__(self, cache, client, api):
+        self.cache = cache
+        self.client = client
+        self.api = api
+
+    def paginate(self, **kwargs):
+        key = self.cache.key(self.client, self.api, kwargs)
+        pages = self.cache.get(key)
+        if pages is not None:
+            yield from pages
+            return
+
+        # Pages are kept encoded until the last one arrives, so a scan that stops part way never caches a partial answer
+        bodies = []
+        for page in self.client.get_paginator(self.api).paginate(**kwargs):
+            bodies.append(encode_page(page))
+            yield(page)
+        self.cache.put(key, bodies)
+
+
+def account_id(session, path, clock=time.time):
+    '''Return the account session's credentials belong to, only asking STS the first time in ACCESS_KEY_TTL we see the access key'''
+    access_key = session.get_credentials().access_key
+    db = sqlite3.connect(path, timeout=60)
+    try:
+        create_schema(db)
+        with db:
+            db.execute("DELETE FROM access_keys WHERE seen_at < ?", (clock() - ACCESS_KEY_TTL,))
+        row = db.execute("SELECT account_id FROM access_keys WHERE access_key=?", (access_key,)).fetchone()
+        if row:
+            return(row[0])
+        account = session.client('sts').get_caller_identity()['Account']
+        with db:
+            db.execute("INSERT OR REPLACE INTO access_keys VALUES (?, ?, ?)", (access_key, account, clock()))
+        return(account)
+    finally:
+        db.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def open_inventory_cache(session, path=DEFAULT_CACHE_FILE, ttl=0, account=None):
+    '''Have every regional_client() for session read and write the cache at path. A ttl of 0 leaves caching off
+
+    Pass account if it is already known, as it is for an assumed role session
+    '''
+    if not ttl:
+        return(None)
+    cache = InventoryCache(path, ttl, account or account_id(session, path))
+    with _caches_lock:
+        _caches[session] = cache
+    return(cache)
+
+
+def get_inventory_cache(session):
+    '''Return the InventoryCache opened for session, or None'''
+    with _caches_lock:
+        return(_caches.get(session))
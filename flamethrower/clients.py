@@ -0,0 +1,77 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Share one boto3 client per (service, region) instead of building one for every call'''
+
+from botocore.config import Config
+import threading
+
+from flamethrower.accounts import assume_role_session, session_account
+from flamethrower.metrics import metrics
+from flamethrower.throttle import controller
+
+# Enough connections for the concurrent fetchers and delete workers to share one client without waiting
+MAX_POOL_CONNECTIONS = 25
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+)
+
+
+class ClientPool(object):
+    '''Create clients from session on first use and hand the same client back after that.
+
+    boto3 clients are thread safe, but creating them from a shared Session is not, so creation is serialized.
+    Every client is attached to the shared ThrottleController and Metrics.
+
+    Asking for a client in another account_id assumes role_name there, once per account. Clients are throttled
+    separately for each account, and account_id, when not given, is the one session was assumed into, if any.
+    '''
+
+    def __init__(self, session, config=CLIENT_CONFIG, role_name=None):
+        self.session = session
+        self.config = config
+        self.role_name = role_name
+        self.account_id = session_account(session)
+        self.clients = {}
+        self.account_sessions = {}
+        self.lock = threading.Lock()
+
+    def client(self, service, region, account_id=None):
+        key = (service, region, account_id)
+        with self.lock:
+            if key not in self.clients:
+                session = self.session
+                if account_id:
+                    if account_id not in self.account_sessions:
+                        self.account_sessions[account_id] = assume_role_session(self.session, account_id, self.role_name)
+                    session = self.account_sessions[account_id]
+                client = session.client(service, region_name=region, config=self.config)
+                controller.attach(client, account_id or self.account_id)
+                metrics.attach(client)
+                self.clients[key] = client
+            return(self.clients[key])
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_client_pool(session):
+    '''Return the ClientPool for session, creating it the first time'''
+    with _pools_lock:
+        if session not in _pools:
+            _pools[session] = ClientPool(session)
+        return(_pools[session])
@@ -0,0 +1,356 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Find the resources each list_* script lists in one region, so they can be run on their own or all together
+
+Every collector is called as collector(session, region, args, logger) and yields (row, tags) for each resource
+to list, with the row's Region (and any other computed columns) already filled in. args holds the list_*
+script options the collector uses, such as --older-than-days, --tag-include and --tag-exclude. If args has a
+region_index (an images.RegionIndex for the region), the EC2 collectors share its sweeps instead of making their own.
+'''
+
+import datetime as dt
+import re
+
+import pytz
+utc=pytz.UTC
+
+from flamethrower.fetch import CachedFetcher
+from flamethrower.images import active_instances, ami_snapshot_index, in_use_image_ids, own_images
+from flamethrower.metrics import metrics
+from flamethrower.scan import batched, regional_client
+from flamethrower.tagfilter import TagFilter
+from flamethrower.traffic import TRAFFIC_METRICS, traffic_totals
+
+EBS_HEADER=["SnapshotId", "Type", "Region", "StartTime", "VolumeSize", "State", "Description", "ImageId"]
+RDS_HEADER=["DBSnapshotIdentifier", "Type", "Region", "SnapshotCreateTime", "AllocatedStorage", "Status", "DBInstanceIdentifier"]
+AMI_HEADER=["ImageId", "Region", "Name", "CreationDate", "PlatformDetails", "State", "Description", "InUse"]
+INSTANCE_HEADER=["InstanceId", "Region", "LaunchTime", "InstanceType", "StateTransitionReason", "DisableApiTermination"]
+ELB_HEADER=["LoadBalancerName", "Region", "DNSName", "CanonicalHostedZoneName", "CreatedTime", "Scheme", "ListensOn", "Type", "LoadBalancerArn", "Traffic"]
+
+# Classic ELBs, then the elbv2 kinds as their Type says them
+ELB_TYPES = ["classic", "application", "network", "gateway"]
+
+# How many instances to look up attributes for at once
+ATTRIBUTE_BATCH_SIZE = 100
+
+# describe_tags accepts up to 20 LoadBalancerNames (or elbv2 ResourceArns) per call
+TAG_BATCH_SIZE = 20
+
+# How many target groups to look up target health for at once
+TARGET_HEALTH_BATCH_SIZE = 100
+
+
+def snapshots(session, region, args, logger):
+    '''Yield the EBS snapshots older than --older-than-days, one page at a time'''
+    ec2_client = regional_client(session, "ec2", region)
+    # Snapshots backing an AMI can't be deleted until the AMI is, so find them all up front
+    region_index = getattr(args, "region_index", None)
+    with metrics.phase("enrichment"):
+        ami_snapshots = region_index.ami_snapshot_index() if region_index else ami_snapshot_index(ec2_client)
+    # --tag-include is done by EC2 itself, which leaves only --tag-exclude for us to check
+    tag_filter = TagFilter(args.tag_include, args.tag_exclude)
+    paginator = ec2_client.get_paginator('describe_snapshots')
+    threshold_time = utc.localize(dt.datetime.today() - dt.timedelta(days=int(args.older_than_days)))
+    logger.info(f"Looking for Snapshots older than {threshold_time}")
+    for page in paginator.paginate(OwnerIds=['self'], Filters=tag_filter.api_filters(), PaginationConfig={'PageSize': 1000}):
+        for s in page['Snapshots']:
+            if tag_filter and not tag_filter.matches(s.get('Tags', [])):
+                continue
+            if s['SnapshotId'] in ami_snapshots:
+                if not args.include_ami_snapshots:
+                    logger.debug(f"Snapshot {s['SnapshotId']} is used by {ami_snapshots[s['SnapshotId']]}, skipping")
+                    continue
+                s['ImageId'] = ami_snapshots[s['SnapshotId']]
+            if s['StartTime'] < threshold_time:
+                logger.debug(f"Snapshot {s['SnapshotId']} was created {s['StartTime']}, which is older that {threshold_time}")
+                s['Region'] = region
+                s['Type'] = "EBS"
+                # parse the annoying way AWS returns tags into a proper dict
+                yield(s, parse_tags(s.get('Tags', [])))
+
+
+def rds_snapshots(session, region, args, logger):
+    '''Yield the manual RDS snapshots older than --older-than-days, one page at a time'''
+    client = regional_client(session, "rds", region)
+    # describe_db_snapshots can't filter on tags, so we check them here
+    tag_filter = TagFilter(args.tag_include, args.tag_exclude)
+    paginator = client.get_paginator('describe_db_snapshots')
+    threshold_time = utc.localize(dt.datetime.today() - dt.timedelta(days=int(args.older_than_days)))
+    logger.info(f"Looking for Snapshots older than {threshold_time}")
+    for page in paginator.paginate(SnapshotType='manual', PaginationConfig={'PageSize': 100}):
+        for s in page['DBSnapshots']:
+            if tag_filter and not tag_filter.matches(s.get('TagList', [])):
+                continue
+            if s['SnapshotCreateTime'] < threshold_time:
+                logger.debug(f"Snapshot {s['DBSnapshotIdentifier']} was created {s['SnapshotCreateTime']}, which is older that {threshold_time}")
+                s['Region'] = region
+                s['Type'] = "RDS"
+                # RDS calls them a TagList
+                yield(s, parse_tags(s.get('TagList', [])))
+
+
+def amis(session, region, args, logger):
+    '''Yield the AMIs older than --older-than-days, one page at a time'''
+    ec2_client = regional_client(session, "ec2", region)
+    # An old AMI can still be what instances and launch templates launch from, so find those up front
+    region_index = getattr(args, "region_index", None)
+    with metrics.phase("enrichment"):
+        in_use = region_index.in_use_image_ids() if region_index else in_use_image_ids(ec2_client)
+    # --tag-include is done by EC2 itself, which leaves only --tag-exclude for us to check. The shared sweep
+    # has every AMI, so then both are checked here
+    tag_filter = TagFilter(args.tag_include, args.tag_exclude)
+    threshold_time = dt.datetime.today() - dt.timedelta(days=int(args.older_than_days))
+    logger.info(f"Looking for AMIs older than {threshold_time}")
+    images = region_index.images() if region_index else own_images(ec2_client, tag_filter.api_filters())
+    for image in images:
+        if tag_filter and not tag_filter.matches(image.get('Tags', [])):
+            continue
+        # The shared sweep's AMIs are also used by the snapshot collector, so they are copied before adding columns
+        s = dict(image, InUse=image['ImageId'] in in_use)
+        if s['InUse'] and not args.include_in_use:
+            logger.debug(f"AMI {s['ImageId']} ({s['Name']}) is used by an instance or launch template, skipping")
+            continue
+        # CreationDate is formatted as 2019-01-13T05:46:55.000Z
+        creation_date = dt.datetime.strptime(s['CreationDate'], '%Y-%m-%dT%H:%M:%S.%fZ')
+        if creation_date < threshold_time:
+            logger.debug(f"AMI {s['ImageId']} ({s['Name']}) was created {s['CreationDate']}, which is older that {threshold_time}")
+            s['Region'] = region
+            yield(s, parse_tags(s.get('Tags', [])))
+
+
+def stopped_instances(session, region, args, logger):
+    '''Yield the instances stopped longer than --older-than-days, with the attributes describe-instances doesn't return'''
+    ec2_client = regional_client(session, "ec2", region)
+    # We need the disableApiTermination attribute which isn't provided by describe-instances. That is one call per
+    # instance, so look them up concurrently and keep the answers by InstanceId
+    protection = CachedFetcher(lambda instance_id: get_termination_protection(ec2_client, instance_id))
+    for batch in batched(list_stopped_instances(ec2_client, region, args, logger), ATTRIBUTE_BATCH_SIZE):
+        with metrics.phase("enrichment"):
+            values = protection.fetch(i['InstanceId'] for i in batch)
+        for i in batch:
+            i['DisableApiTermination'] = values[i['InstanceId']]
+            i['Region'] = region
+            yield(i, parse_tags(i.get('Tags', [])))
+
+
+def get_termination_protection(ec2_client, instance_id):
+    '''Return the value of the disableApiTermination attribute for one instance'''
+    response = ec2_client.describe_instance_attribute(Attribute='disableApiTermination', InstanceId=instance_id)
+    return(response['DisableApiTermination']['Value'])
+
+
+def list_stopped_instances(ec2_client, region, args, logger):
+    '''Yield the instances stopped longer than --older-than-days, one page at a time'''
+    # --tag-include is done by EC2 itself, which leaves only --tag-exclude for us to check. The shared sweep
+    # has every instance that isn't terminated, so then both, and the state, are checked here
+    tag_filter = TagFilter(args.tag_include, args.tag_exclude)
+    threshold_time = dt.datetime.today() - dt.timedelta(days=int(args.older_than_days))
+    logger.info(f"Looking for Stopped Instances older than {threshold_time}")
+    region_index = getattr(args, "region_index", None)
+    if region_index:
+        instances = (dict(i) for i in region_index.instances() if i['State']['Name'] == "stopped")
+    else:
+        instances = active_instances(ec2_client, ['stopped'], tag_filter.api_filters())
+    for i in instances:
+        # print(json.dumps(i, indent=2, default=str))
+        if tag_filter and not tag_filter.matches(i.get('Tags', [])):
+            continue
+
+        # We only want to process Instances that have been stopped longer than --older-than-days
+        # The only way to know when an instance was stopped is to parse the StateTransitionReason
+        if i['StateTransitionReason'] == "":
+            logger.error(f"Instance {i['InstanceId']} in state {i['State']['Name']} has no StateTransitionReason")
+            continue  # nothing to do here, move along, move along
+
+        # Need to extract a date from string that looks like: "User initiated (2021-01-11 22:52:15 GMT)"
+        # Note: so far the sample set of this string is small, more logic may be needed here
+        try:
+            stopped_date_str = re.search(r'\((.+?)\)', i['StateTransitionReason']).group(1)
+            # print(stopped_date_str)
+            stopped_date = dt.datetime.strptime(stopped_date_str, '%Y-%m-%d %H:%M:%S %Z')
+            # print(stopped_date)
+
+            # If the stopped date is older than our threshold, return the instance info
+            if stopped_date < threshold_time:
+                logger.debug(f"Instance {i['InstanceId']} is {i['State']['Name']} for {i['StateTransitionReason']}, which is older that {threshold_time}")
+                yield(i)
+        except AttributeError:
+            pass
+
+
+def inactive_elbs(session, region, args, logger):
+    '''Yield the load balancers of the --elb-types with nothing registered behind them, with their tags.
+    With --idle-days, the ones with too little traffic in that many days are yielded too
+    '''
+    elb_types = getattr(args, "elb_types", None) or ELB_TYPES
+    if "classic" in elb_types:
+        yield from inactive_classic_elbs(session, region, args, logger)
+    elbv2_types = [t for t in elb_types if t != "classic"]
+    if elbv2_types:
+        yield from inactive_elbv2s(session, region, args, elbv2_types, logger)
+
+
+def inactive_classic_elbs(session, region, args, logger):
+    '''Yield the classic load balancers with no registered instances (or with --idle-days, too little traffic), with their tags'''
+    client = regional_client(session, "elb", region)
+    tag_filter = TagFilter(args.tag_include, args.tag_exclude)
+    unused = with_idle(session, region, args, list_elbs(client), lambda elb: not elb['Instances'], logger)
+    for batch in batched(unused, TAG_BATCH_SIZE):
+        # parse the annoying way AWS returns tags into a proper dict, for the whole batch in one call
+        with metrics.phase("enrichment"):
+            tags = get_elb_tags(client, [elb['LoadBalancerName'] for elb in batch])
+        for elb in batch:
+            # Classic ELB tags only come from describe_tags, so they can only be checked here
+            if tag_filter and not tag_filter.matches(tags[elb['LoadBalancerName']]):
+                continue
+            elb['Region'] = region
+            elb['ListensOn'] = ""
+            for l in elb['ListenerDescriptions']:
+                elb['ListensOn'] += f"{l['Listener']['LoadBalancerPort']} "
+            yield(elb, tags[elb['LoadBalancerName']])
+
+
+def get_elb_tags(client, LoadBalancerNames):
+    '''Return a dict of tags for each of up to TAG_BATCH_SIZE load balancers, keyed by LoadBalancerName'''
+    output = {name: {} for name in LoadBalancerNames}
+    response = client.describe_tags(LoadBalancerNames=LoadBalancerNames)
+    # Weird response syntax - https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/elb.html#ElasticLoadBalancing.Client.describe_tags
+    for td in response['TagDescriptions']:
+        for t in td['Tags']:
+            output[td['LoadBalancerName']][t['Key']] = t['Value']
+    return(output)
+
+
+def list_elbs(client):
+    '''Yield every classic load balancer, one page at a time'''
+    paginator = client.get_paginator('describe_load_balancers')
+    for page in paginator.paginate(PaginationConfig={'PageSize': 400}):
+        for elb in page['LoadBalancerDescriptions']:
+            # So it can be told apart from the elbv2 ones
+            elb['Type'] = "classic"
+            yield(elb)
+
+
+def inactive_elbv2s(session, region, args, elb_types, logger):
+    '''Yield the application, network and gateway load balancers with target groups but no registered targets
+    (or with --idle-days, too little traffic), with their tags
+
+    A load balancer with no target groups at all may still be serving redirects or fixed responses from its
+    listeners, so it is only yielded if --idle-days finds too little traffic through it.
+
+    Every load balancer, target group and target health in the region is gathered in a few sweeps and joined
+    in memory, so there are no per load balancer calls. Listeners would need one, so ListensOn is left empty.
+    '''
+    client = regional_client(session, "elbv2", region)
+    tag_filter = TagFilter(args.tag_include, args.tag_exclude)
+    load_balancers = [lb for lb in list_elbv2s(client) if lb['Type'] in elb_types]
+    if not load_balancers:
+        return
+    with metrics.phase("enrichment"):
+        targets = registered_targets(client, set(lb['LoadBalancerArn'] for lb in load_balancers))
+    unused = with_idle(session, region, args, load_balancers, lambda lb: targets.get(lb['LoadBalancerArn']) == 0, logger)
+    for batch in batched(unused, TAG_BATCH_SIZE):
+        with metrics.phase("enrichment"):
+            tags = get_elbv2_tags(client, [lb['LoadBalancerArn'] for lb in batch])
+        for lb in batch:
+            if tag_filter and not tag_filter.matches(tags[lb['LoadBalancerArn']]):
+                continue
+            lb['Region'] = region
+            lb['ListensOn'] = ""
+            yield(lb, tags[lb['LoadBalancerArn']])
+
+
+def list_elbv2s(client):
+    '''Yield every application, network and gateway load balancer, one page at a time'''
+    paginator = client.get_paginator('describe_load_balancers')
+    for page in paginator.paginate(PaginationConfig={'PageSize': 400}):
+        for lb in page['LoadBalancers']:
+            yield(lb)
+
+
+def registered_targets(client, LoadBalancerArns):
+    '''Return how many targets are registered behind each of LoadBalancerArns that has a target group, keyed by
+    LoadBalancerArn. The ones with no target groups are left out, rather than given 0
+
+    One sweep of describe_target_groups finds which target groups each load balancer sends to. Target health
+    can only be asked one target group at a time, so those calls go out concurrently, in batches.
+    '''
+    target_groups = {}  # TargetGroupArn -> the LoadBalancerArns it is behind
+    paginator = client.get_paginator('describe_target_groups')
+    for page in paginator.paginate(PaginationConfig={'PageSize': 400}):
+        for tg in page['TargetGroups']:
+            arns = [arn for arn in tg['LoadBalancerArns'] if arn in LoadBalancerArns]
+            if arns:
+                target_groups[tg['TargetGroupArn']] = arns
+
+    output = {arn: 0 for arns in target_groups.values() for arn in arns}
+    health = CachedFetcher(lambda arn: len(client.describe_target_health(TargetGroupArn=arn)['TargetHealthDescriptions']))
+    for batch in batched(target_groups, TARGET_HEALTH_BATCH_SIZE):
+        for tg_arn, count in health.fetch(batch).items():
+            for arn in target_groups[tg_arn]:
+                output[arn] += count
+    return(output)
+
+
+def get_elbv2_tags(client, ResourceArns):
+    '''Return a dict of tags for each of up to TAG_BATCH_SIZE elbv2 load balancers, keyed by LoadBalancerArn'''
+    output = {arn: {} for arn in ResourceArns}
+    response = client.describe_tags(ResourceArns=ResourceArns)
+    for td in response['TagDescriptions']:
+        output[td['ResourceArn']] = parse_tags(td.get('Tags', []))
+    return(output)
+
+
+def with_idle(session, region, args, load_balancers, is_empty, logger):
+    '''Yield the load_balancers is_empty(lb) says have nothing registered behind them.
+
+    With --idle-days, the rest are yielded too if their traffic over that many days is no more than
+    --idle-max-requests (or --idle-max-bytes, for the kinds that only count bytes), with it as their Traffic.
+    One created within those days hasn't been around long enough to judge, and one CloudWatch has no
+    datapoints for can't be judged, so neither is yielded. All their traffic is looked up at the end, in as
+    few GetMetricData calls as possible
+    '''
+    idle_days = getattr(args, "idle_days", 0)
+    created_before = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=idle_days)
+    registered = []
+    for lb in load_balancers:
+        if is_empty(lb):
+            logger.debug(f"{lb['Type']} load balancer {lb['LoadBalancerName']} has nothing registered")
+            yield(lb)
+        elif idle_days and lb['CreatedTime'] > created_before:
+            logger.debug(f"{lb['Type']} load balancer {lb['LoadBalancerName']} was created {lb['CreatedTime']}, less than {idle_days} days ago")
+        elif idle_days:
+            registered.append(lb)
+    if not registered:
+        return
+
+    cloudwatch = regional_client(session, "cloudwatch", region)
+    with metrics.phase("enrichment"):
+        totals = traffic_totals(cloudwatch, registered, idle_days)
+    for lb, total in zip(registered, totals):
+        metric_name = TRAFFIC_METRICS[lb['Type']][1]
+        if total is None:
+            logger.debug(f"{lb['Type']} load balancer {lb['LoadBalancerName']} has no {metric_name} datapoints in {idle_days} days")
+        elif total <= (args.idle_max_requests if metric_name == "RequestCount" else args.idle_max_bytes):
+            logger.debug(f"{lb['Type']} load balancer {lb['LoadBalancerName']} had {total:g} {metric_name} in {idle_days} days")
+            lb['Traffic'] = total
+            yield(lb)
+
+
+def parse_tags(tagset):
+    output = {}
+    for t in tagset:
+        output[t['Key']] = t['Value']
+    return(output)
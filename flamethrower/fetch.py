@@ -0,0 +1,44 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Run per-resource lookups concurrently, remembering every answer'''
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flamethrower.clients import MAX_POOL_CONNECTIONS
+
+# Each worker holds one of the client's pooled connections, so more workers than that just queue up
+DEFAULT_FETCH_WORKERS = MAX_POOL_CONNECTIONS
+
+
+class CachedFetcher(object):
+    '''Call lookup_fn(key) for many keys over a bounded pool of threads, caching each result by key'''
+
+    def __init__(self, lookup_fn, max_workers=DEFAULT_FETCH_WORKERS):
+        self.lookup_fn = lookup_fn
+        self.max_workers = int(max_workers)
+        self.cache = {}
+
+    def fetch(self, keys):
+        '''Return a dict of {key: result} for keys, only calling lookup_fn for keys not already cached'''
+        keys = list(keys)
+        missing = [k for k in dict.fromkeys(keys) if k not in self.cache]
+        if len(missing) > 1 and self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+                results = list(executor.map(self.lookup_fn, missing))
+        else:
+            results = [self.lookup_fn(k) for k in missing]
+        for key, result in zip(missing, results):
+            self.cache[key] = result
+        return({k: self.cache[k] for k in keys})
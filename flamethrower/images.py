@@ -0,0 +1,113 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Indexes of how a region's AMIs relate to its other resources, each built in one paginated sweep'''
+
+import threading
+
+from flamethrower.scan import regional_client
+
+# Terminated instances hang around for a while, but they won't be launching again
+ACTIVE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
+
+def ami_snapshot_index(ec2_client, images=None):
+    '''Return a dict of {SnapshotId: ImageId} for every snapshot backing one of our AMIs in the client's region
+
+    Pass images if our AMIs have already been described, to save sweeping them again
+    '''
+    index = {}
+    for image in own_images(ec2_client) if images is None else images:
+        for device in image.get('BlockDeviceMappings', []):
+            if 'Ebs' in device and 'SnapshotId' in device['Ebs']:
+                index[device['Ebs']['SnapshotId']] = image['ImageId']
+    return(index)
+
+
+def in_use_image_ids(ec2_client, instances=None):
+    '''Return the set of ImageIds that instances or launch templates in the client's region still launch from
+
+    Launch templates are checked at their $Latest and $Default versions, which is what anything using them will launch.
+    Pass instances if the region's active_instances() have already been described, to save sweeping them again
+    '''
+    image_ids = set()
+    for i in active_instances(ec2_client) if instances is None else instances:
+        image_ids.add(i['ImageId'])
+
+    paginator = ec2_client.get_paginator('describe_launch_template_versions')
+    for page in paginator.paginate(Versions=['$Latest', '$Default'], PaginationConfig={'PageSize': 200}):
+        for v in page['LaunchTemplateVersions']:
+            # ImageId can also be an SSM parameter reference, which won't match any of our AMIs anyway
+            image_id = v.get('LaunchTemplateData', {}).get('ImageId')
+            if image_id:
+                image_ids.add(image_id)
+    return(image_ids)
+
+
+def own_images(ec2_client, filters=None):
+    '''Yield every AMI we own in the client's region, matching the describe filters if any, one page at a time'''
+    paginator = ec2_client.get_paginator('describe_images')
+    for page in paginator.paginate(Owners=['self'], Filters=filters or [], PaginationConfig={'PageSize': 1000}):
+        yield from page['Images']
+
+
+def active_instances(ec2_client, states=ACTIVE_STATES, filters=None):
+    '''Yield every instance in the client's region in one of states, matching the describe filters if any'''
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(
+        Filters=[{'Name': 'instance-state-name', 'Values': states}] + (filters or []),
+        PaginationConfig={'PageSize': 1000}
+    )
+    for page in pages:
+        for r in page['Reservations']:
+            yield from r['Instances']
+
+
+class RegionIndex(object):
+    '''The sweeps of one region's AMIs and instances, made once on first use and shared by every collector given it.
+
+    list_all.py runs the snapshot, AMI and instance collectors for a region at once. On their own, the snapshot
+    and AMI collectors would both describe our AMIs, and the AMI and instance collectors would both describe the
+    instances. Each sweep has its own lock, so a collector needing one that is underway waits for it instead of
+    repeating it.
+    '''
+
+    def __init__(self, session, region):
+        self.session = session
+        self.region = region
+        self.results = {}
+        self.locks = {name: threading.Lock() for name in ["images", "instances", "ami_snapshot_index", "in_use_image_ids"]}
+
+    def images(self):
+        '''Return a list of every AMI we own in the region'''
+        return(self._once("images", lambda: list(own_images(self.ec2_client()))))
+
+    def instances(self):
+        '''Return a list of every instance in the region that isn't terminated'''
+        return(self._once("instances", lambda: list(active_instances(self.ec2_client()))))
+
+    def ami_snapshot_index(self):
+        return(self._once("ami_snapshot_index", lambda: ami_snapshot_index(self.ec2_client(), self.images())))
+
+    def in_use_image_ids(self):
+        return(self._once("in_use_image_ids", lambda: in_use_image_ids(self.ec2_client(), self.instances())))
+
+    def ec2_client(self):
+        return(regional_client(self.session, "ec2", self.region))
+
+    def _once(self, name, build):
+        with self.locks[name]:
+            if name not in self.results:
+                self.results[name] = build()
+            return(self.results[name])
@@ -0,0 +1,126 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Remember what a purge_* run has already done, so a restart can pick up where it left off'''
+
+import json
+import os
+import sys
+import threading
+import time
+
+# fsync the journal after this many entries, or this many seconds, whichever comes first
+SYNC_EVERY = 100
+SYNC_INTERVAL = 1.0
+
+
+class Journal(object):
+    '''An append-only file of completed actions, one JSON object per line.
+
+    Entries are handed to the OS as soon as they are recorded, so they survive the script dying, but are only
+    fsync'd in batches. Losing power or the OS can lose the last SYNC_EVERY entries or SYNC_INTERVAL seconds of
+    them, and those actions are simply done again on resume.
+
+    With resume, the entries already in the file are loaded and new ones are appended. With restart the file is
+    started over. With neither, an existing journal is the only record of what an earlier run deleted, so it is
+    left alone and FileExistsError is raised.
+    '''
+
+    def __init__(self, path, resume=False, restart=False, sync_every=SYNC_EVERY, sync_interval=SYNC_INTERVAL, clock=time.monotonic):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.clock = clock
+        self.entries = {}  # key -> the details recorded with it
+        if not resume and not restart and os.path.exists(path) and os.path.getsize(path):
+            raise FileExistsError(f"The journal {path} is from an earlier run")
+        if resume and os.path.exists(path):
+            self.entries = load_journal(path)
+        self.resumed = set(self.entries)
+        self.file = open(path, 'a' if resume else 'w')
+        if self.file.tell() and not ends_with_newline(path):
+            # Don't glue our first entry onto a line a crash cut short
+            self.file.write("\n")
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = clock()
+
+    def done(self, key):
+        '''Return True if key was recorded, in this run or the one being resumed'''
+        return(key in self.entries)
+
+    def resumed_total(self, detail):
+        '''Add up detail (like size) over the entries recorded by the run being resumed'''
+        return(sum(self.entries[key].get(detail, 0) for key in self.resumed))
+
+    def record(self, key, **details):
+        '''Record that the action named key is complete. Safe to call from worker threads'''
+        with self.lock:
+            self.entries[key] = details
+            self.file.write(json.dumps(dict(details, key=key), default=str) + "\n")
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or self.clock() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = self.clock()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
+
+
+def load_journal(path):
+    '''Return {key: details} for every complete line of the journal at path'''
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A crash mid-write leaves a partial last line. That action just gets done again
+                continue
+            entries[entry.pop('key')] = entry
+    return(entries)
+
+
+def ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return(f.read(1) == b"\n")
+
+
+def default_journal_file(infile):
+    '''Keep the journal next to the CSV it is for'''
+    return(f"{infile}.journal")
+
+
+def open_journal(args, logger):
+    '''Return the Journal for a purge_* run, at --journal or next to --infile, or None for a dry run that isn't resuming.
+
+    Every completed delete is recorded in it, so --resume can skip it after a crash. A dry run only reads it. If a
+    journal is left from an earlier run and neither --resume nor --restart was given, this logs why and exits
+    '''
+    if not (args.actually_do_it or args.resume):
+        return(None)
+    try:
+        return(Journal(args.journal or default_journal_file(args.infile), resume=args.resume, restart=args.restart))
+    except FileExistsError as e:
+        logger.critical(f"{e}. Pass --resume to carry on from it, or --restart to start it over. Aborting...")
+        sys.exit(1)
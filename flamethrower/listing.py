@@ -0,0 +1,82 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''What every list_* script does: scan each account's regions with a collector, and write the rows it finds'''
+
+from functools import partial
+
+from flamethrower.accounts import account_session, read_account_ids, scan_accounts, worker_logger
+from flamethrower.cache import open_inventory_cache
+from flamethrower.metrics import metrics
+from flamethrower.regions import get_regions
+from flamethrower.scan import scan_regions
+from flamethrower.throttle import controller
+from flamethrower.writers import open_writer
+
+
+def list_resources(args, logger, collector, header, noun):
+    '''Write every (row, tags) collector(session, region, args, logger) yields to --outfile, logging how many
+    noun were found in each region.
+
+    With --accounts every account is scanned in its own process, and each row says which account it came from.
+    Otherwise we just scan the account our credentials are for
+    '''
+    metrics.write_at_exit(args.metrics_file, args.metrics_textfile)
+
+    account_ids = read_account_ids(args.accounts, args.accounts_file) or [None]
+    if account_ids != [None]:
+        header = ["AccountId"] + header
+
+    # Rows are written (or for a CSV, spooled to disk) as they are found. The format comes from the --outfile extension
+    writer = open_writer(args.outfile, header)
+
+    # Anything the scan does as the rows are pulled through it is counted as its own phase, not as writing
+    with metrics.phase("writing"):
+        scan_fn = partial(scan_account, args, partial(timed_collector, collector))
+        for account_id, regions in scan_accounts(account_ids, scan_fn, args.max_processes, logger):
+            for region, rows in regions:
+                count = 0
+                for row, tags in rows:
+                    row['AccountId'] = account_id
+                    writer.writerow(row, tags)
+                    count += 1
+                logger.info(f"Found {count} {noun} to cleanup in {region}" + (f" of {account_id}" if account_id else ""))
+
+        # Now finish the output file
+        writer.close()
+
+    # Let them know if AWS slowed us down
+    controller.log_summary(logger)
+
+
+def scan_account(args, scan_region, account_id=None):
+    '''Return (region, rows) for every region of account_id, or of our own account if it is None, where rows is
+    what scan_region(session, region, args, logger) returns. The regions are scanned in parallel
+    '''
+    session = account_session(args.profile, account_id, args.role_name)
+
+    # This can be running in an --accounts worker process, which doesn't have the script's logger set up
+    logger = worker_logger(args)
+
+    # With --cache-ttl, describe results are kept on disk and reused by the next run within that many seconds
+    open_inventory_cache(session, args.cache_file, args.cache_ttl, account_id)
+
+    with metrics.phase("region_discovery"):
+        regions = get_regions(session, args, account_id)
+    return(scan_regions(regions, lambda r: scan_region(session, r, args, logger), args.max_workers))
+
+
+def timed_collector(collector, session, region, args, logger):
+    '''Return collector's rows for region, with the time spent getting them counted as listing'''
+    return(metrics.timed("listing", collector(session, region, args, logger)))
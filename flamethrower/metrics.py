@@ -0,0 +1,264 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Record what every API call and every phase of a run cost, and write it out as JSON and a Prometheus textfile'''
+
+from contextlib import contextmanager
+import atexit
+import datetime as dt
+import json
+import os
+import sys
+import threading
+import time
+
+# Upper bounds, in seconds, of the API latency histogram buckets. Anything slower lands in +Inf
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class ApiStats(object):
+    '''Counts, a latency histogram, retries and response bytes for one (service, operation, region)'''
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def merge(self, other):
+        self.calls += other['calls']
+        self.errors += other['errors']
+        self.retries += other['retries']
+        self.bytes += other['bytes']
+        self.seconds += other['seconds']
+        self.buckets = [a + b for a, b in zip(self.buckets, other['buckets'])]
+
+    def export(self):
+        return({'calls': self.calls, 'errors': self.errors, 'retries': self.retries, 'bytes': self.bytes,
+                'seconds': self.seconds, 'buckets': list(self.buckets)})
+
+
+class Metrics(object):
+    '''Collect API call stats through botocore events, and how long the run spends in each phase.
+
+    A call's latency runs from when it is sent, after any wait for a ThrottleController slot, until its final
+    response, so it includes retries and their backoff. Each retry is counted, and every response's bytes.
+
+    Phase time is exclusive. When a phase starts inside another on the same thread, the outer one stops
+    counting until it is over, so "writing" around a loop that pulls rows through "listing" only gets the
+    time spent writing. Worker threads count their own time, so phases can add up to more than the wall time.
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.started_at = dt.datetime.now(dt.timezone.utc)
+        self.api = {}      # (service, operation, region) -> ApiStats
+        self.phases = {}   # name -> [seconds, times entered]
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def reset(self):
+        '''Forget everything recorded so far. Only call this outside of any phase'''
+        with self.lock:
+            self.api = {}
+            self.phases = {}
+            self.local = threading.local()
+
+    def attach(self, client):
+        '''Register the handlers that record client's calls'''
+        service, region = client.meta.service_model.service_name, client.meta.region_name
+        events = client.meta.events
+        events.register('before-call', lambda context, **kwargs: self._before_call(context))
+        events.register('response-received', lambda context, response_dict=None, **kwargs: self._response_received(context, response_dict))
+        events.register('after-call', lambda model, context, http_response, **kwargs:
+                        self._after_call(service, model.name, region, context, http_response.status_code >= 300))
+        events.register('after-call-error', lambda context, event_name, **kwargs:
+                        self._after_call(service, event_name.rsplit(".", 1)[1], region, context, True))
+
+    def _before_call(self, context):
+        context['flamethrower_sent'] = self.clock()
+        context['flamethrower_attempts'] = 0
+        context['flamethrower_bytes'] = 0
+
+    def _response_received(self, context, response_dict):
+        # Fires once for every attempt, including the ones that are retried
+        context['flamethrower_attempts'] = context.get('flamethrower_attempts', 0) + 1
+        if response_dict and response_dict.get('body'):
+            context['flamethrower_bytes'] = context.get('flamethrower_bytes', 0) + len(response_dict['body'])
+
+    def _after_call(self, service, operation, region, context, failed):
+        sent = context.pop('flamethrower_sent', None)
+        if sent is None:
+            return  # Answered before it was sent, like a Stubber does
+        seconds = self.clock() - sent
+        key = (service, operation, region)
+        with self.lock:
+            if key not in self.api:
+                self.api[key] = ApiStats()
+            stats = self.api[key]
+            stats.observe(seconds)
+            stats.retries += max(0, context.pop('flamethrower_attempts', 1) - 1)
+            stats.bytes += context.pop('flamethrower_bytes', 0)
+            if failed:
+                stats.errors += 1
+
+    @contextmanager
+    def phase(self, name):
+        '''Count the time spent in the with block as phase name'''
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def timed(self, name, iterable):
+        '''Yield from iterable, counting the time spent getting each item as phase name'''
+        iterator = iter(iterable)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            yield(item)
+
+    def _enter(self, name):
+        now = self.clock()
+        stack = self.local.__dict__.setdefault('stack', [])
+        if stack:
+            self._add(stack[-1], now - self.local.since, 0)
+        stack.append(name)
+        self.local.since = now
+
+    def _exit(self):
+        now = self.clock()
+        self._add(self.local.stack.pop(), now - self.local.since, 1)
+        self.local.since = now
+
+    def _add(self, name, seconds, entered):
+        with self.lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += entered
+
+    def export(self):
+        '''Return everything recorded, in a form that can be pickled back from a worker process and merge()d'''
+        with self.lock:
+            return({'api': {key: stats.export() for key, stats in self.api.items()},
+                    'phases': {name: list(phase) for name, phase in self.phases.items()}})
+
+    def merge(self, exported):
+        '''Add in what another process recorded'''
+        with self.lock:
+            for key, other in exported['api'].items():
+                if key not in self.api:
+                    self.api[key] = ApiStats()
+                self.api[key].merge(other)
+            for name, (seconds, entered) in exported['phases'].items():
+                phase = self.phases.setdefault(name, [0.0, 0])
+                phase[0] += seconds
+                phase[1] += entered
+
+    def summary(self, script):
+        '''Return the run as a JSON friendly dict'''
+        exported = self.export()
+        api = []
+        for (service, operation, region), stats in sorted(exported['api'].items()):
+            histogram = dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], stats.pop('buckets')))
+            api.append(dict(service=service, operation=operation, region=region, histogram=histogram, **stats))
+        return({
+            'script': script,
+            'started': self.started_at.isoformat(),
+            'wall_seconds': self.clock() - self.started,
+            'phases': {name: {'seconds': seconds, 'count': entered} for name, (seconds, entered) in sorted(exported['phases'].items())},
+            'api': api,
+        })
+
+    def textfile(self, script):
+        '''Return the run in the Prometheus text exposition format, for node_exporter's textfile collector'''
+        exported = self.export()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{k}="{escape_label(v)}"' for k, v in [('script', script)] + labels)
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}")
+
+        metric("flamethrower_run_seconds", "gauge", "How long the run took", [("", [], self.clock() - self.started)])
+        metric("flamethrower_run_start_timestamp_seconds", "gauge", "When the run started",
+               [("", [], self.started_at.timestamp())])
+        metric("flamethrower_phase_seconds", "gauge", "Time spent in each phase of the run",
+               [("", [('phase', name)], seconds) for name, (seconds, entered) in sorted(exported['phases'].items())])
+
+        api = sorted(exported['api'].items())
+        labelled = [([('service', s), ('operation', o), ('region', r)], stats) for (s, o, r), stats in api]
+        for name, field, help_text in [
+            ("flamethrower_api_calls_total", 'calls', "API calls made"),
+            ("flamethrower_api_errors_total", 'errors', "API calls that ended in an error"),
+            ("flamethrower_api_retries_total", 'retries', "Retries of API calls"),
+            ("flamethrower_api_response_bytes_total", 'bytes', "Bytes in API responses, including retried ones"),
+        ]:
+            metric(name, "counter", help_text, [("", labels, stats[field]) for labels, stats in labelled])
+
+        samples = []
+        for labels, stats in labelled:
+            cumulative = 0
+            for bound, count in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], stats['buckets']):
+                cumulative += count
+                samples.append(("_bucket", labels + [('le', bound)], cumulative))
+            samples.append(("_sum", labels, stats['seconds']))
+            samples.append(("_count", labels, stats['calls']))
+        metric("flamethrower_api_call_duration_seconds", "histogram", "API call latency, including retries", samples)
+        return("\n".join(lines) + "\n")
+
+    def write(self, json_file=None, textfile=None, script=None):
+        '''Write the JSON summary and the Prometheus textfile, whichever are given'''
+        script = script or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        if json_file:
+            with open(json_file, "w") as f:
+                json.dump(self.summary(script), f, indent=2)
+        if textfile:
+            # node_exporter could read a half written file, so write it alongside and rename it into place
+            with open(textfile + ".tmp", "w") as f:
+                f.write(self.textfile(script))
+            os.replace(textfile + ".tmp", textfile)
+
+    def write_at_exit(self, json_file=None, textfile=None):
+        '''Write the metrics when the script exits, however it exits'''
+        if json_file or textfile:
+            atexit.register(self.write, json_file, textfile)
+
+
+def escape_label(value):
+    return(str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+
+
+# Shared by every client the ClientPool hands out, and every phase of the run
+metrics = Metrics()
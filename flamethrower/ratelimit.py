@@ -0,0 +1,63 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Token buckets to keep each region under the AWS API rate limits'''
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    '''Allow rate calls per second on average, with bursts of up to burst calls. Safe to share between threads'''
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Take a token, sleeping until one is available'''
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token now even if it puts us in debt, so callers queue up in the order they arrived
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+
+
+class RegionRateLimits(object):
+    '''One TokenBucket per (service, region), created on first use from a dict of per-service rates.
+
+    region can also be a (region, account_id) pair, so each account gets its own buckets
+    '''
+
+    def __init__(self, rates):
+        self.rates = rates
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, service, region):
+        key = (service, region)
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.rates[service])
+            bucket = self.buckets[key]
+        bucket.acquire()
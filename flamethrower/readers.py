@@ -0,0 +1,64 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Read back the inventories the list_* scripts write, one row at a time'''
+
+import csv
+import gzip
+import json
+
+from flamethrower.writers import PARQUET_BATCH_SIZE, csv_value, output_format, pyarrow
+
+
+def read_rows(infile):
+    '''Yield each row of infile as a dict, the same as csv.DictReader would give for the CSV version of it.
+
+    Every value is a string, and tags are flattened back into tag.* keys. The format is picked by extension.
+    '''
+    fmt = output_format(infile)
+    if fmt == "jsonl":
+        rows = read_jsonl(infile)
+    elif fmt == "parquet":
+        rows = read_parquet(infile)
+    else:
+        with open(infile, newline='') as csvfile:
+            yield from csv.DictReader(csvfile)
+        return
+
+    for row, tags in rows:
+        row = {k: csv_value(v) for k, v in row.items()}
+        # The CSV always has a tag.Name column, which the purge scripts use in their messages
+        row['tag.Name'] = ""
+        for key, value in tags:
+            row[f"tag.{key}"] = value
+        yield(row)
+
+
+def read_jsonl(infile):
+    '''Yield (row, tags) from a gzip'd JSON Lines inventory'''
+    with gzip.open(infile, 'rt') as f:
+        for line in f:
+            row = json.loads(line)
+            yield(row, row.pop('Tags', {}).items())
+
+
+def read_parquet(infile):
+    '''Yield (row, tags) from a Parquet inventory, reading PARQUET_BATCH_SIZE rows at a time'''
+    if pyarrow is None:
+        raise ImportError("Reading .parquet files needs pyarrow. Run: pip install pyarrow")
+    parquet_file = pyarrow.parquet.ParquetFile(infile)
+    for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_SIZE):
+        for row in batch.to_pylist():
+            # Arrow hands a map column back as a list of (key, value) pairs
+            yield(row, row.pop('Tags', None) or [])
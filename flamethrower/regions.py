@@ -0,0 +1,98 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Work out which regions to scan, without asking EC2 on every run or scanning regions that aren't enabled'''
+
+from fnmatch import fnmatchcase
+import json
+import sqlite3
+import time
+
+from flamethrower.cache import account_id
+from flamethrower.scan import regional_client
+
+# The regions an account can have resources in. Any other OptInStatus is an opt-in region nobody opted into
+ENABLED_STATUSES = ["opt-in-not-required", "opted-in"]
+
+# Keeping the list means a sqlite file under ~, and an sts:GetCallerIdentity call for credentials it hasn't seen,
+# so it is off unless asked for. Opting in to a region is rare, so a day (86400) is a good --regions-ttl
+DEFAULT_REGIONS_TTL = 0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS regions (account_id TEXT PRIMARY KEY, regions TEXT NOT NULL, fetched_at REAL NOT NULL);
+'''
+
+
+def get_regions(session, args, account=None):
+    '''Return the regions to scan, with us-east-1 first.
+
+    --region is just that region. --regions names or patterns (like "eu-*") pick from the enabled regions, and
+    if they are all plain names they are used as is, without looking anything up. --exclude-regions names or
+    patterns are then left out. Otherwise it is every enabled region, kept in the cache file for --regions-ttl
+    seconds if that is set. Pass account if it is already known, as it is for an assumed role session
+    '''
+    # If we specifed a region on the CLI, return a list of just that
+    if args.region:
+        return([args.region])
+
+    include = args.regions or []
+    if include and not any(is_pattern(r) for r in include):
+        # In the order given, but still us-east-1 first, like the enabled regions
+        regions = sorted(dict.fromkeys(include), key=lambda r: r != "us-east-1")
+    else:
+        regions = enabled_regions(session, args.cache_file, args.regions_ttl, account)
+        if include:
+            regions = [r for r in regions if matches(r, include)]
+    return([r for r in regions if not matches(r, args.exclude_regions or [])])
+
+
+def enabled_regions(session, path, ttl=DEFAULT_REGIONS_TTL, account=None, clock=time.time):
+    '''Return the account's enabled regions, us-east-1 first, from the cache at path if they were saved in the last ttl seconds'''
+    if not ttl:
+        return(describe_enabled_regions(session))
+
+    account = account or account_id(session, path)
+    db = sqlite3.connect(path, timeout=60)
+    try:
+        db.executescript(SCHEMA)
+        row = db.execute("SELECT regions, fetched_at FROM regions WHERE account_id=?", (account,)).fetchone()
+        if row and row[1] >= clock() - ttl:
+            return(json.loads(row[0]))
+        regions = describe_enabled_regions(session)
+        with db:
+            db.execute("INSERT OR REPLACE INTO regions VALUES (?, ?, ?)", (account, json.dumps(regions), clock()))
+        return(regions)
+    finally:
+        db.close()
+
+
+def describe_enabled_regions(session):
+    '''Ask EC2 for the regions enabled in session's account, us-east-1 first'''
+    ec2 = regional_client(session, "ec2", "us-east-1")
+    response = ec2.describe_regions(AllRegions=True, Filters=[{'Name': 'opt-in-status', 'Values': ENABLED_STATUSES}])
+    output = ['us-east-1']
+    for r in response['Regions']:
+        # return us-east-1 first, but dont return it twice
+        if r['RegionName'] == "us-east-1" or r.get('OptInStatus', ENABLED_STATUSES[0]) not in ENABLED_STATUSES:
+            continue
+        output.append(r['RegionName'])
+    return(output)
+
+
+def is_pattern(name):
+    return(any(c in name for c in "*?["))
+
+
+def matches(region, patterns):
+    return(any(fnmatchcase(region, p) for p in patterns))
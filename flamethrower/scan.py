@@ -0,0 +1,155 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Fan the per-region listing work out over a bounded pool of threads'''
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Empty, Full, Queue
+import threading
+
+from flamethrower.cache import get_inventory_cache
+from flamethrower.clients import get_client_pool
+from flamethrower.metrics import metrics
+
+DEFAULT_MAX_WORKERS = 8
+
+# How many rows a region worker can get ahead of the reader before it waits
+ROW_QUEUE_SIZE = 1000
+
+
+def regional_client(session, service, region):
+    '''Return the pooled boto3 client for service in region. Safe to call from scan worker threads
+
+    If an inventory cache was opened for session, the client's read calls go through it
+    '''
+    client = get_client_pool(session).client(service, region)
+    cache = get_inventory_cache(session)
+    if cache:
+        return(cache.wrap(client))
+    return(client)
+
+
+def batched(iterable, size):
+    '''Yield lists of up to size items from iterable, without reading ahead any further than that'''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield(batch)
+            batch = []
+    if batch:
+        yield(batch)
+
+
+def scan_regions(regions, scan_fn, max_workers=DEFAULT_MAX_WORKERS):
+    '''Call scan_fn(region) for every region and yield (region, rows) in the order regions were given.
+
+    scan_fn may return a list or a generator. With a single worker the generator is handed straight back.
+    Otherwise regions are scanned concurrently on up to max_workers threads, and each streams its rows through
+    a queue of at most ROW_QUEUE_SIZE rows, so memory doesn't grow with the size of the account. Each region's
+    rows must be read before the next region's. The results still come back in the order given, so anything
+    written from them is identical to a serial run.
+    '''
+    max_workers = int(max_workers)
+    if max_workers <= 1 or len(regions) <= 1:
+        for region in regions:
+            yield(region, scan_fn(region))
+        return
+
+    stop = threading.Event()
+    queues = [Queue(maxsize=ROW_QUEUE_SIZE) for region in regions]
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(regions)))
+    try:
+        # The pool starts regions in the order they were submitted, so the one being read is always running
+        for region, q in zip(regions, queues):
+            executor.submit(feed, q, stop, partial(scan_fn, region))
+        for region, q in zip(regions, queues):
+            yield(region, drain(q))
+    finally:
+        # If we stopped reading early, don't leave the workers blocked on a full queue
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def merged(sources):
+    '''Run every one of sources (functions returning an iterable) on its own thread, and yield all their items.
+
+    Items come in whatever order they are produced, but the items from any one source stay in their order.
+    At most ROW_QUEUE_SIZE items are waiting to be read at any time.
+    '''
+    stop = threading.Event()
+    q = Queue(maxsize=ROW_QUEUE_SIZE)
+    threads = [threading.Thread(target=feed, args=(q, stop, source), daemon=True) for source in sources]
+    for thread in threads:
+        thread.start()
+    try:
+        yield from drain(q, len(threads))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+class Failed(object):
+    '''What a feed() puts on its queue when its source raised'''
+
+    def __init__(self, error):
+        self.error = error
+
+
+# What a feed() puts on its queue when its source is finished
+DONE = object()
+
+
+def feed(q, stop, source):
+    '''Put each item source() yields on q, then DONE, or Failed if it raises. Gives up once stop is set'''
+    try:
+        for item in source():
+            if not put(q, stop, item):
+                return
+        put(q, stop, DONE)
+    except Exception as e:
+        put(q, stop, Failed(e))
+
+
+def put(q, stop, item):
+    '''Put item on q, waiting for room. Return False if stop was set first'''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return(True)
+        except Full:
+            pass
+    return(False)
+
+
+def drain(q, sources=1):
+    '''Yield the items on q until sources feeds are DONE, re-raising any that Failed.
+
+    Time spent blocked on an empty q is counted as the waiting phase, not as whatever the caller is doing
+    '''
+    done = 0
+    while done < sources:
+        try:
+            item = q.get_nowait()
+        except Empty:
+            with metrics.phase("waiting"):
+                item = q.get()
+        if item is DONE:
+            done += 1
+        elif isinstance(item, Failed):
+            raise item.error
+        else:
+            yield(item)
@@ -0,0 +1,130 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Wait on many EBS snapshots at once without polling each of them every few seconds'''
+
+from botocore.exceptions import ClientError
+import re
+import time
+
+from flamethrower.scan import batched
+
+# How many SnapshotIds to ask describe_snapshots about in one call
+POLL_BATCH_SIZE = 200
+
+# Bounds on how long to wait before asking about a snapshot again
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 300
+
+# Before a snapshot has reported any progress, assume it takes about this long per GB of volume
+SECONDS_PER_GB = 0.5
+
+
+class SnapshotPoller(object):
+    '''Track the pending snapshots in one region and poll them in batched describe_snapshots calls.
+
+    Each snapshot is given its own next poll time. Until it reports any progress that is based on the size of
+    the volume, then on how fast its Progress has been moving, so big snapshots are asked about less often
+    and small ones are noticed as soon as they finish.
+    '''
+
+    def __init__(self, ec2_client, clock=time.monotonic):
+        self.ec2_client = ec2_client
+        self.clock = clock
+        self.snapshots = {}  # SnapshotId -> what we know about it
+
+    def add(self, snapshots):
+        '''Start tracking the snapshots returned by create_snapshots or create_snapshot'''
+        now = self.clock()
+        for s in snapshots:
+            interval = clamp(s.get('VolumeSize', 0) * SECONDS_PER_GB)
+            self.snapshots[s['SnapshotId']] = {
+                'State': s.get('State', 'pending'),
+                'Progress': parse_progress(s.get('Progress')),
+                'Started': now,
+                'Interval': interval,
+                'NextPoll': now + interval,
+            }
+
+    def forget(self, snapshot_ids):
+        for snapshot_id in snapshot_ids:
+            self.snapshots.pop(snapshot_id, None)
+
+    def state(self, snapshot_ids):
+        '''Return "error" if any of snapshot_ids failed, "pending" if any are still running, otherwise "completed"'''
+        states = [self.snapshots[snapshot_id]['State'] for snapshot_id in snapshot_ids]
+        if "error" in states:
+            return("error")
+        if "pending" in states:
+            return("pending")
+        return("completed")
+
+    def seconds_until_next_poll(self):
+        '''How long until a pending snapshot is due to be polled, or None if nothing is pending'''
+        due = [s['NextPoll'] for s in self.snapshots.values() if s['State'] == "pending"]
+        if not due:
+            return(None)
+        return(max(0, min(due) - self.clock()))
+
+    def poll(self):
+        '''Describe every pending snapshot that is due, POLL_BATCH_SIZE at a time'''
+        now = self.clock()
+        due = [snapshot_id for snapshot_id, s in self.snapshots.items() if s['State'] == "pending" and s['NextPoll'] <= now]
+        for batch in batched(due, POLL_BATCH_SIZE):
+            for s in self.describe(batch):
+                self.update(s, now)
+
+    def describe(self, snapshot_ids):
+        '''Describe snapshot_ids, marking any that no longer exist as errors rather than failing the whole batch'''
+        while snapshot_ids:
+            try:
+                return(self.ec2_client.describe_snapshots(SnapshotIds=snapshot_ids)['Snapshots'])
+            except ClientError as e:
+                if e.response['Error']['Code'] != "InvalidSnapshot.NotFound":
+                    raise
+                missing = re.findall(r"snap-[0-9a-f]+", e.response['Error']['Message'])
+                if not missing:
+                    raise
+                for snapshot_id in missing:
+                    if snapshot_id in self.snapshots:
+                        self.snapshots[snapshot_id]['State'] = "error"
+                snapshot_ids = [snapshot_id for snapshot_id in snapshot_ids if snapshot_id not in missing]
+        return([])
+
+    def update(self, s, now):
+        '''Record the latest State and Progress of a snapshot and schedule its next poll'''
+        known = self.snapshots[s['SnapshotId']]
+        progress = parse_progress(s.get('Progress'))
+        if progress > known['Progress'] and progress > 0:
+            # Poll again about halfway through the time it looks like it has left
+            rate = progress / max(now - known['Started'], 1)
+            known['Interval'] = clamp((100 - progress) / rate / 2)
+        else:
+            # No progress since we last looked, so back off
+            known['Interval'] = clamp(known['Interval'] * 2)
+        known['State'] = s['State']
+        known['Progress'] = progress
+        known['NextPoll'] = now + known['Interval']
+
+
+def parse_progress(progress):
+    '''Turn a Progress string like "42%" into 42.0'''
+    try:
+        return(float(str(progress).rstrip("%")))
+    except ValueError:
+        return(0.0)
+
+
+def clamp(interval):
+    return(min(max(interval, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL))
@@ -0,0 +1,67 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Pick resources by tag, in the describe call itself where the API allows it'''
+
+
+class TagFilter(object):
+    '''Match resources that have every --tag-include tag and none of the --tag-exclude tags.
+
+    Each spec is "key=value", or just "key" for any value. Repeating a key with different values matches
+    any of them. The specs are compiled into {key: set of values, or None for any value} once up front.
+    '''
+
+    def __init__(self, include=None, exclude=None):
+        self.include = compile_specs(include)
+        self.exclude = compile_specs(exclude)
+
+    def __bool__(self):
+        return(bool(self.include or self.exclude))
+
+    def api_filters(self):
+        '''Return the EC2 describe Filters for the include specs. EC2 has no way to filter tags out'''
+        filters = []
+        for key, values in self.include.items():
+            if values is None:
+                filters.append({'Name': 'tag-key', 'Values': [key]})
+            else:
+                filters.append({'Name': f"tag:{key}", 'Values': sorted(values)})
+        return(filters)
+
+    def matches(self, tags):
+        '''Return True if tags, either AWS's [{'Key': k, 'Value': v}] list or a parsed {k: v} dict, should be kept'''
+        if isinstance(tags, dict):
+            pairs = tags.items()
+        else:
+            pairs = ((t['Key'], t['Value']) for t in tags)
+        found = 0
+        for key, value in pairs:
+            if key in self.exclude and (self.exclude[key] is None or value in self.exclude[key]):
+                return(False)
+            if key in self.include and (self.include[key] is None or value in self.include[key]):
+                found += 1
+        # Tag keys are unique on a resource, so this is every include key matching
+        return(found == len(self.include))
+
+
+def compile_specs(specs):
+    '''Turn ["key=value", "key"] into {key: {values} or None}'''
+    compiled = {}
+    for spec in specs or []:
+        key, sep, value = spec.partition("=")
+        if not sep:
+            compiled[key] = None
+        elif key not in compiled or compiled[key] is not None:
+            compiled.setdefault(key, set()).add(value)
+    return(compiled)
@@ -0,0 +1,187 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Back off when AWS throttles us, and shrink or grow how many calls we make at once to match (AIMD)'''
+
+import random
+import threading
+import time
+
+# Error codes the AWS APIs use to say "slow down"
+THROTTLE_CODES = {
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottledException",
+    "RequestLimitExceeded", "TooManyRequestsException", "RequestThrottled", "SlowDown",
+    "ProvisionedThroughputExceededException", "BandwidthLimitExceeded", "EC2ThrottledException",
+    "PriorRequestNotComplete",
+}
+
+# How many calls to allow in flight per (service, region, account) before anything has been throttled
+INITIAL_LIMIT = 25
+MAX_LIMIT = 100
+
+# Full jitter exponential backoff: sleep a random time up to BASE_DELAY * 2^attempt, capped at MAX_DELAY
+BASE_DELAY = 0.5
+MAX_DELAY = 20
+MAX_THROTTLE_RETRIES = 10
+
+
+class AdaptiveLimit(object):
+    '''A semaphore whose size is halved when a call is throttled and grows by one per limit's worth of successes.
+
+    Calls throttled together all get the same answer from AWS, so the limit is only halved once for them. Each
+    decrease starts a new epoch, and a throttle only counts against the limit if its call was sent in the
+    current epoch, after the last decrease.
+    '''
+
+    def __init__(self, limit=INITIAL_LIMIT, minimum=1, maximum=MAX_LIMIT):
+        self.limit = float(limit)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.epoch = 0
+        self.throttles = 0
+        self.throttled_seconds = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def decrease(self, epoch=None):
+        '''Multiplicative decrease after a throttle of a call sent in epoch, unless the limit was already cut since'''
+        with self.condition:
+            self.throttles += 1
+            if epoch is not None and epoch < self.epoch:
+                return
+            self.limit = max(self.minimum, self.limit / 2)
+            self.epoch += 1
+
+    def increase(self):
+        '''Additive increase after a call that went through without being throttled'''
+        with self.condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class ThrottleController(object):
+    '''Track an AdaptiveLimit for every (service, region, account) and attach it to boto3 clients through botocore events.
+
+    Each account has its own API rate limits, so one account being throttled doesn't slow down the others.
+
+    Every API call takes a slot from its limit before it is sent and gives it back when it finishes, including
+    any retries. When AWS throttles a call the limit is halved (once for calls throttled together), and the call
+    is retried after a jittered exponential backoff, with the time spent waiting recorded so it can be reported
+    at the end of the run.
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.limits = {}
+        self.merged = []
+        self.lock = threading.Lock()
+
+    def reset(self):
+        '''Forget every limit and what they were throttled. Clients already attached keep their old limits'''
+        with self.lock:
+            self.limits = {}
+            self.merged = []
+
+    def limit(self, service, region, account_id=None):
+        key = (service, region, account_id)
+        with self.lock:
+            if key not in self.limits:
+                self.limits[key] = AdaptiveLimit()
+            return(self.limits[key])
+
+    def attach(self, client, account_id=None):
+        '''Register the controller's handlers on a boto3 client for account_id, or our own account if it is None'''
+        service_id = client.meta.service_model.service_id.hyphenize()
+        limit = self.limit(client.meta.service_model.service_name, client.meta.region_name, account_id)
+        events = client.meta.events
+        events.register('before-call', lambda context, **kwargs: self._before_call(limit, context))
+        events.register('after-call', lambda context, **kwargs: self._after_call(limit, context))
+        events.register('after-call-error', lambda context, **kwargs: self._after_call(limit, context))
+        events.register('request-created', lambda request, **kwargs: self._request_created(limit, request))
+        # Go ahead of botocore's own retry handler so throttles are retried on our schedule
+        events.register_first(f'needs-retry.{service_id}', lambda **kwargs: self._needs_retry(limit, **kwargs))
+
+    def _before_call(self, limit, context):
+        limit.acquire()
+        context['flamethrower_throttled'] = False
+
+    def _after_call(self, limit, context):
+        if 'flamethrower_throttled' not in context:
+            return  # Never took a slot
+        limit.release()
+        if not context.pop('flamethrower_throttled'):
+            limit.increase()
+
+    def _needs_retry(self, limit, response=None, attempts=1, request_dict=None, **kwargs):
+        if response is None:
+            return(None)
+        code = response[1].get('Error', {}).get('Code')
+        if code not in THROTTLE_CODES:
+            return(None)
+        context = request_dict['context']
+        limit.decrease(context.get('flamethrower_epoch'))
+        if attempts > MAX_THROTTLE_RETRIES:
+            return(False)  # Give up and let the caller see the throttling error
+        context['flamethrower_throttled'] = True
+        context['flamethrower_backoff_start'] = self.clock()
+        return(random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempts)))
+
+    def _request_created(self, limit, request):
+        # Fires again for every retry, once the backoff sleep is over. Note which epoch each attempt goes out in
+        request.context['flamethrower_epoch'] = limit.epoch
+        started = request.context.pop('flamethrower_backoff_start', None)
+        if started is not None:
+            with limit.condition:
+                limit.throttled_seconds += self.clock() - started
+
+    def summary(self):
+        '''Return (service, region, account_id, throttles, throttled_seconds, limit) for everything that was
+        throttled, here or in a worker process whose summary was merge()d in. account_id is None for our own account'''
+        output = list(self.merged)
+        with self.lock:
+            limits = list(self.limits.items())
+        for (service, region, account_id), limit in limits:
+            if limit.throttles:
+                output.append((service, region, account_id, limit.throttles, limit.throttled_seconds, int(limit.limit)))
+        return(sorted(output, key=lambda row: (row[0], row[1], row[2] or "")))
+
+    def export(self):
+        '''Return the summary, in a form that can be pickled back from a worker process and merge()d'''
+        return(self.summary())
+
+    def merge(self, exported):
+        '''Add in the summary of another process'''
+        with self.lock:
+            self.merged.extend(tuple(row) for row in exported)
+
+    def log_summary(self, logger):
+        for service, region, account_id, throttles, seconds, final_limit in self.summary():
+            where = f"{region} of {account_id}" if account_id else region
+            logger.warning(f"{service} in {where} was throttled {throttles} times, spending {seconds:.1f} seconds "
+                           f"backing off. Ended at {final_limit} calls at once")
+
+
+# Shared by every client the ClientPool hands out
+controller = ThrottleController()
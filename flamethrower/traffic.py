@@ -0,0 +1,79 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Add up how much traffic load balancers have had, hundreds at a time through CloudWatch GetMetricData'''
+
+import datetime as dt
+
+from flamethrower.scan import batched
+
+# GetMetricData takes up to 500 queries per call
+METRIC_BATCH_SIZE = 500
+
+# The CloudWatch namespace and metric that say a load balancer of each Type is being used. Network and gateway
+# load balancers don't count requests, so they go by bytes
+TRAFFIC_METRICS = {
+    "classic": ("AWS/ELB", "RequestCount"),
+    "application": ("AWS/ApplicationELB", "RequestCount"),
+    "network": ("AWS/NetworkELB", "ProcessedBytes"),
+    "gateway": ("AWS/GatewayELB", "ProcessedBytes"),
+}
+
+# One datapoint per day keeps even a 90 day window well under GetMetricData's 100,800 datapoint limit
+PERIOD = 86400
+
+
+def traffic_totals(cloudwatch, load_balancers, days, now=None):
+    '''Return the total of each load balancer's TRAFFIC_METRICS metric over the last days, in the order given.
+
+    load_balancers are rows from the collectors, so each has a Type, and a LoadBalancerArn unless it is classic.
+    A load balancer CloudWatch returned no datapoints for at all totals None, not 0, as its metrics may just
+    not have been published yet
+    '''
+    end = (now or dt.datetime.now(dt.timezone.utc)).replace(minute=0, second=0, microsecond=0)
+    start = end - dt.timedelta(days=int(days))
+    output = []
+    paginator = cloudwatch.get_paginator('get_metric_data')
+    for batch in batched(load_balancers, METRIC_BATCH_SIZE):
+        totals = [None] * len(batch)
+        queries = [metric_query(f"lb{i}", lb) for i, lb in enumerate(batch)]
+        for page in paginator.paginate(MetricDataQueries=queries, StartTime=start, EndTime=end):
+            for result in page['MetricDataResults']:
+                if result['Values']:
+                    i = int(result['Id'][2:])
+                    totals[i] = (totals[i] or 0.0) + sum(result['Values'])
+        output.extend(totals)
+    return(output)
+
+
+def metric_query(query_id, lb):
+    '''Return the GetMetricData query for lb's traffic, summed over each PERIOD'''
+    namespace, metric_name = TRAFFIC_METRICS[lb['Type']]
+    return({
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {'Namespace': namespace, 'MetricName': metric_name, 'Dimensions': [metric_dimension(lb)]},
+            'Period': PERIOD,
+            'Stat': "Sum",
+        },
+        'ReturnData': True,
+    })
+
+
+def metric_dimension(lb):
+    '''Return the dimension CloudWatch keeps lb's metrics under'''
+    if lb['Type'] == "classic":
+        return({'Name': "LoadBalancerName", 'Value': lb['LoadBalancerName']})
+    # elbv2 metrics go by the end of the ARN, like app/my-alb/50dc6c495c0c9188
+    return({'Name': "LoadBalancer", 'Value': lb['LoadBalancerArn'].split(":loadbalancer/", 1)[1]})
@@ -0,0 +1,83 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Route work items to a small pool of worker threads for each region'''
+
+from queue import Queue
+import threading
+
+DEFAULT_WORKERS_PER_REGION = 4
+
+
+class RegionWorkers(object):
+    '''Call work_fn(region, item) for every submitted item on workers_per_region threads per region.
+
+    Each region gets its own bounded queue and threads the first time an item for it is submitted, so a slow
+    or throttled region doesn't hold up the others. Whatever work_fn returns is added up in total. If work_fn
+    raises, the remaining items are skipped and join() re-raises the first exception.
+    '''
+
+    def __init__(self, work_fn, workers_per_region=DEFAULT_WORKERS_PER_REGION, queue_size=1000):
+        self.work_fn = work_fn
+        self.workers_per_region = int(workers_per_region)
+        self.queue_size = queue_size
+        self.queues = {}
+        self.threads = []
+        self.total = 0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def submit(self, region, item):
+        if self.errors:
+            raise self.errors[0]
+        # Items for one region can be submitted from several threads at once, so only one of them may create its
+        # queue. The put is outside the lock, as it waits when the queue is full
+        with self.lock:
+            if region not in self.queues:
+                self.queues[region] = Queue(maxsize=self.queue_size)
+                for n in range(self.workers_per_region):
+                    thread = threading.Thread(target=self._run, args=(region, self.queues[region]), daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+            q = self.queues[region]
+        q.put(item)
+
+    def join(self):
+        '''Wait for every submitted item to be worked, and return the total'''
+        with self.lock:
+            queues, threads = list(self.queues.values()), list(self.threads)
+        for q in queues:
+            for n in range(self.workers_per_region):
+                q.put(None)
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return(self.total)
+
+    def _run(self, region, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if self.errors:
+                continue  # Something already failed, just drain the queue
+            try:
+                result = self.work_fn(region, item)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            if result:
+                with self.lock:
+                    self.total += result
@@ -0,0 +1,159 @@
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Write inventories without holding the whole scan in memory, as CSV, gzip'd JSON Lines or Parquet'''
+
+import csv
+import gzip
+import json
+import os
+import tempfile
+
+# Parquet is optional, and only needed to write or read .parquet files
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# How many rows to buffer for each Parquet row group
+PARQUET_BATCH_SIZE = 10000
+
+
+class CsvWriter(object):
+    '''Write rows to a CSV whose tag.* columns are only known once the scan is finished.
+
+    Rows are spooled to a temp file as they arrive, keeping just the header columns and the tags.
+    close() then writes the real CSV, with every tag key seen, in one sequential pass over the spool.
+    '''
+
+    def __init__(self, outfile, header, tag_keys=("tag.Name",)):
+        self.outfile = outfile
+        self.header = header
+        # A dict is an insertion-ordered set, so columns come out in the order the tags were first seen
+        self.tag_keys = dict.fromkeys(tag_keys)
+        self.rowcount = 0
+        self.spool = tempfile.TemporaryFile(mode='w+', newline='', dir=os.path.dirname(os.path.abspath(outfile)))
+        self.spool_writer = csv.writer(self.spool)
+
+    def writerow(self, row, tags=None):
+        '''Spool the header fields of row, followed by each tag as a key, value pair'''
+        spooled = [row.get(h) for h in self.header]
+        for key, value in (tags or {}).items():
+            # we prepend with "tag." to avoid overriding a resource key
+            self.tag_keys.setdefault(f"tag.{key}")
+            spooled.append(f"tag.{key}")
+            spooled.append(value)
+        self.spool_writer.writerow(spooled)
+        self.rowcount += 1
+
+    def close(self):
+        '''Write the final CSV with the full header and discard the spool'''
+        width = len(self.header)
+        tag_keys = list(self.tag_keys)
+        self.spool.seek(0)
+        with open(self.outfile, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(self.header + tag_keys)
+            for spooled in csv.reader(self.spool):
+                tag_pairs = spooled[width:]
+                tags = dict(zip(tag_pairs[0::2], tag_pairs[1::2]))
+                writer.writerow(spooled[:width] + [tags.get(key, "") for key in tag_keys])
+        self.spool.close()
+
+
+class JsonlWriter(object):
+    '''Write one JSON object per row to a gzip'd file, with the tags as a single Tags object.
+
+    Rows are written as they arrive, so unlike a CSV nothing needs to be spooled.
+    '''
+
+    def __init__(self, outfile, header):
+        self.outfile = outfile
+        self.header = header
+        self.rowcount = 0
+        self.file = gzip.open(outfile, 'wt')
+
+    def writerow(self, row, tags=None):
+        record = {h: row.get(h) for h in self.header}
+        record['Tags'] = tags or {}
+        # default=str writes datetimes the same way the CSV does
+        self.file.write(json.dumps(record, default=str) + "\n")
+        self.rowcount += 1
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter(object):
+    '''Write rows to a Parquet file, PARQUET_BATCH_SIZE at a time, with the tags as a map<string, string> column.
+
+    Every header column is a string, written exactly as it would be in the CSV, so the purge scripts
+    see the same values whichever format they read.
+    '''
+
+    def __init__(self, outfile, header):
+        if pyarrow is None:
+            raise ImportError("Writing .parquet files needs pyarrow. Run: pip install pyarrow")
+        self.outfile = outfile
+        self.header = header
+        self.rowcount = 0
+        fields = [pyarrow.field(h, pyarrow.string()) for h in header]
+        fields.append(pyarrow.field('Tags', pyarrow.map_(pyarrow.string(), pyarrow.string())))
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(outfile, self.schema, compression='zstd')
+        self.batch = []
+
+    def writerow(self, row, tags=None):
+        record = {h: csv_value(row.get(h)) for h in self.header}
+        record['Tags'] = list((tags or {}).items())
+        self.batch.append(record)
+        self.rowcount += 1
+        if len(self.batch) >= PARQUET_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_table(pyarrow.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def csv_value(value):
+    '''Return value as the csv module would write it'''
+    if value is None:
+        return("")
+    return(str(value))
+
+
+def output_format(path):
+    '''Return "jsonl", "parquet" or "csv", from the file extension'''
+    if path.endswith(".jsonl.gz"):
+        return("jsonl")
+    if path.endswith(".parquet"):
+        return("parquet")
+    return("csv")
+
+
+def open_writer(outfile, header):
+    '''Return a writer for outfile, picked by its extension: .jsonl.gz, .parquet, or CSV for anything else'''
+    fmt = output_format(outfile)
+    if fmt == "jsonl":
+        return(JsonlWriter(outfile, header))
+    if fmt == "parquet":
+        return(ParquetWriter(outfile, header))
+    return(CsvWriter(outfile, header))
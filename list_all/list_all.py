@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# Copyright 2021 Chris Farris <chrisf@primeharbor.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from botocore.exceptions import ClientError
+from functools import partial
+import argparse
+import logging
+import os
+import sys
+
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower import collectors
+from flamethrower.accounts import DEFAULT_MAX_PROCESSES, DEFAULT_ROLE_NAME, read_account_ids, scan_accounts
+from flamethrower.cache import DEFAULT_CACHE_FILE
+from flamethrower.images import RegionIndex
+from flamethrower.listing import scan_account
+from flamethrower.metrics import metrics
+from flamethrower.regions import DEFAULT_REGIONS_TTL
+from flamethrower.scan import DEFAULT_MAX_WORKERS, merged
+from flamethrower.throttle import controller
+from flamethrower.writers import open_writer
+
+# Everything list_all.py can list: the collector, its header, the file it's written to (the same name the
+# list_* script defaults to, before the extension), and the option holding its --older-than-days
+RESOURCE_TYPES = {
+    "snapshots": (collectors.snapshots, collectors.EBS_HEADER, "snapshots-to-delete", "snapshots_older_than_days"),
+    "amis": (collectors.amis, collectors.AMI_HEADER, "amis-to-delete", "amis_older_than_days"),
+    "instances": (collectors.stopped_instances, collectors.INSTANCE_HEADER, "instances-to-terminate", "instances_older_than_days"),
+    "elbs": (collectors.inactive_elbs, collectors.ELB_HEADER, "orphaned-elbs", None),
+    "rds-snapshots": (collectors.rds_snapshots, collectors.RDS_HEADER, "rds-snapshots-to-delete", "snapshots_older_than_days"),
+}
+DEFAULT_TYPES = ["snapshots", "amis", "instances", "elbs"]
+
+
+def main(args, logger):
+    '''Executes the Primary Logic of the Fast Fix'''
+
+    metrics.write_at_exit(args.metrics_file, args.metrics_textfile)
+
+    # The --accounts to scan, or None for just the account our credentials are for
+    account_ids = read_account_ids(args.accounts, args.accounts_file) or [None]
+
+    # One output per resource type, each just like the list_* script for it would write, so the purge_* scripts can read it
+    os.makedirs(args.outdir, exist_ok=True)
+    writers = {}
+    for resource_type in args.types:
+        collector, header, name, days_option = RESOURCE_TYPES[resource_type]
+        if account_ids != [None]:
+            header = ["AccountId"] + header
+        outfile = os.path.join(args.outdir, f"{name}.{args.format}")
+        logger.info(f"Writing {resource_type} to {outfile}")
+        writers[resource_type] = open_writer(outfile, header)
+
+    with metrics.phase("writing"):
+        for account_id, regions in scan_accounts(account_ids, partial(scan_account, args, scan_region), args.max_processes, logger):
+            for region, found in regions:
+                counts = dict.fromkeys(args.types, 0)
+                for resource_type, row, tags in found:
+                    row['AccountId'] = account_id
+                    writers[resource_type].writerow(row, tags)
+                    counts[resource_type] += 1
+                logger.info(f"Found {', '.join(f'{n} {t}' for t, n in counts.items())} to cleanup in {region}" + (f" of {account_id}" if account_id else ""))
+
+        # Now finish the output files
+        for writer in writers.values():
+            writer.close()
+
+    # Let them know if AWS slowed us down
+    controller.log_summary(logger)
+
+    exit(0)
+
+
+def scan_region(session, region, args, logger):
+    '''Run every resource type's collector in region at once, and yield (resource_type, row, tags) as they find them
+
+    The collectors all get their clients from the same pool, so each client is only built once per region, and
+    they share one RegionIndex, so the AMI and instance sweeps more than one of them needs are only made once
+    '''
+    region_index = RegionIndex(session, region)
+    return(merged([partial(collect, session, region, args, resource_type, region_index, logger) for resource_type in args.types]))
+
+
+def collect(session, region, args, resource_type, region_index, logger):
+    '''Yield (resource_type, row, tags) from one resource type's collector, given the options its list_* script would have had'''
+    collector, header, name, days_option = RESOURCE_TYPES[resource_type]
+    collector_args = argparse.Namespace(**vars(args))
+    collector_args.region_index = region_index
+    if days_option:
+        collector_args.older_than_days = getattr(args, days_option)
+    for row, tags in metrics.timed("listing", collector(session, region, collector_args, logger)):
+        yield(resource_type, row, tags)
+
+
+def do_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", help="print debugging info", action='store_true')
+    parser.add_argument("--error", help="print error info only", action='store_true')
+    parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
+    parser.add_argument("--region", help="Only Process Specified Region")
+    parser.add_argument("--regions", help="Only process these regions. Patterns like eu-* pick from the enabled regions", nargs='+')
+    parser.add_argument("--exclude-regions", help="Don't process these regions, by name or pattern", nargs='+')
+    parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
+    parser.add_argument("--types", help="Resource types to list", nargs='+', choices=list(RESOURCE_TYPES), default=DEFAULT_TYPES)
+    parser.add_argument("--outdir", help="Write one file per resource type into this directory", default=".")
+    parser.add_argument("--format", help="Format of the files written", choices=["csv", "jsonl.gz", "parquet"], default="csv")
+    parser.add_argument("--snapshots-older-than-days", help="Only return snapshots older than X days", default=365)
+    parser.add_argument("--amis-older-than-days", help="Only return AMIs older than X days", default=365)
+    parser.add_argument("--instances-older-than-days", help="Only return instances that have been stopped more than X days", default=90)
+    parser.add_argument("--include-ami-snapshots", help="List EBS snapshots used by an AMI too, with the AMI in the ImageId column", action='store_true')
+    parser.add_argument("--include-in-use", help="List AMIs still used by an instance or launch template too", action='store_true')
+    parser.add_argument("--elb-types", help="Kinds of load balancer to look at (default: all of them)", nargs='+', choices=collectors.ELB_TYPES, default=collectors.ELB_TYPES)
+    parser.add_argument("--idle-days", help="Also list load balancers with something registered, but too little traffic in the last N days", type=int, default=0)
+    parser.add_argument("--idle-max-requests", help="With --idle-days, most requests a classic or application load balancer can have had and be idle", type=float, default=0)
+    parser.add_argument("--idle-max-bytes", help="With --idle-days, most bytes a network or gateway load balancer can have processed and be idle", type=float, default=0)
+    parser.add_argument("--tag-include", help="Only list resources with this tag, as key=value or just key. Repeat to require more tags", action='append')
+    parser.add_argument("--tag-exclude", help="Don't list resources with this tag, as key=value or just key. Repeatable", action='append')
+    parser.add_argument("--max-workers", help="Scan up to this many regions in parallel", type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument("--cache-ttl", help="Reuse describe results cached in the last N seconds, and cache new ones (0 disables the cache)", type=int, default=0)
+    parser.add_argument("--cache-file", help="SQLite file for --cache-ttl and --regions-ttl", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--regions-ttl", help="Keep the account's list of enabled regions in --cache-file and reuse it for N seconds, like 86400 (the default, 0, looks them up every run)",
+                        type=int, default=DEFAULT_REGIONS_TTL)
+    parser.add_argument("--accounts", help="Scan these accounts, by assuming --role-name in each one", nargs='+')
+    parser.add_argument("--accounts-file", help="Scan the accounts listed one per line in this file, by assuming --role-name in each one")
+    parser.add_argument("--role-name", help="Role to assume in each account", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--max-processes", help="Scan up to this many accounts in parallel", type=int, default=DEFAULT_MAX_PROCESSES)
+    parser.add_argument("--metrics-file", help="When done, write the API calls and time spent in each phase to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
+
+    args = parser.parse_args()
+
+    # Each type is listed once, in the order given
+    args.types = list(dict.fromkeys(args.types))
+
+    return(args)
+
+if __name__ == '__main__':
+
+    args = do_args()
+
+    # Logging idea stolen from: https://docs.python.org/3/howto/logging.html#configuring-logging
+    # create console handler and set level to debug
+    logger = logging.getLogger(sys.argv[0])
+    ch = logging.StreamHandler()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    elif args.error:
+        logger.setLevel(logging.ERROR)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # Silence Boto3 & Friends
+    logging.getLogger('botocore').setLevel(logging.WARNING)
+    logging.getLogger('boto3').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+    # create formatter
+    if args.timestamp:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    else:
+        formatter = logging.Formatter('%(levelname)s - %(message)s')
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    # add ch to logger
+    logger.addHandler(ch)
+
+    try:
+        main(args, logger)
+    except KeyboardInterrupt:
+        exit(1)
+    except ClientError as e:
+        if e.response['Error']['Code'] == "RequestExpired":
+            print("Credentials expired")
+            exit(1)
+        else:
+            raise
@@ -25,95 +25,23 @@ import os
 import re
 import sys
 
-import pytz
-utc=pytz.UTC
-
-HEADER=["ImageId", "Region", "Name", "CreationDate", "PlatformDetails", "State", "Description"]
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower.accounts import DEFAULT_MAX_PROCESSES, DEFAULT_ROLE_NAME
+from flamethrower.cache import DEFAULT_CACHE_FILE
+from flamethrower.collectors import AMI_HEADER, amis
+from flamethrower.listing import list_resources
+from flamethrower.regions import DEFAULT_REGIONS_TTL
+from flamethrower.scan import DEFAULT_MAX_WORKERS
 
 
 def main(args, logger):
     '''Executes the Primary Logic of the Fast Fix'''
 
-    # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-    else:
-        session = boto3.Session()
-
-    amis = []  # array of rows to pass to DictWriter
-    tag_keys = ["tag.Name"]  # We need to pass all the tag keys to the DictWriter
-
-    # Get all the Regions for this account
-    for region in get_regions(session, args):
-        ec2_client = session.client("ec2", region_name=region)
-
-        ami_list = list_amis(ec2_client, region, args)
-        logger.info(f"Found {len(ami_list)} amis to cleanup in {region}")
-        for s in ami_list:
-            s['Region'] = region
-            # parse the annoying way AWS returns tags into a proper dict
-            if 'Tags' in s:
-                tags = parse_tags(s['Tags'])
-                for key, value in tags.items():
-                    # we need to capture the list of tag_keys for Dictwriter, but we prepend with "tag." to avoid
-                    # overriding an instance key
-                    if f"tag.{key}" not in tag_keys:
-                        tag_keys.append(f"tag.{key}")
-                    s[f"tag.{key}"] = value  # now add to the instance dict
-
-            amis.append(s)
-
-    # Now write the final CSV file
-    with open(args.outfile, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=HEADER + tag_keys, extrasaction='ignore')
-        writer.writeheader()
-        for s in amis:
-            writer.writerow(s)
-
+    list_resources(args, logger, amis, AMI_HEADER, "amis")
     exit(0)
 
 
-def list_amis(ec2_client, region, args):
-    output = []
-    response = ec2_client.describe_images(Owners=['self'])
-    threshold_time = dt.datetime.today() - dt.timedelta(days=int(args.older_than_days))
-    logger.info(f"Looking for AMIs older than {threshold_time}")
-    for s in response['Images']:
-        # CreationDate is formatted as 2019-01-13T05:46:55.000Z
-        creation_date = dt.datetime.strptime(s['CreationDate'], '%Y-%m-%dT%H:%M:%S.%fZ')
-        if creation_date < threshold_time:
-            logger.debug(f"AMI {s['ImageId']} ({s['Name']}) was created {s['CreationDate']}, which is older that {threshold_time}")
-            output.append(s)
-
-    return(output)
-
-
-def parse_tags(tagset):
-    output = {}
-    for t in tagset:
-        output[t['Key']] = t['Value']
-    return(output)
-
-
-def get_regions(session, args):
-    '''Return a list of regions with us-east-1 first. If --region was specified, return a list wth just that'''
-
-    # If we specifed a region on the CLI, return a list of just that
-    if args.region:
-        return([args.region])
-
-    # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2', region_name="us-east-1")
-    response = ec2.describe_regions()
-    output = ['us-east-1']
-    for r in response['Regions']:
-        # return us-east-1 first, but dont return it twice
-        if r['RegionName'] == "us-east-1":
-            continue
-        output.append(r['RegionName'])
-    return(output)
-
-
 def do_args():
     import argparse
     parser = argparse.ArgumentParser()
@@ -121,9 +49,25 @@ def do_args():
     parser.add_argument("--error", help="print error info only", action='store_true')
     parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
     parser.add_argument("--region", help="Only Process Specified Region")
+    parser.add_argument("--regions", help="Only process these regions. Patterns like eu-* pick from the enabled regions", nargs='+')
+    parser.add_argument("--exclude-regions", help="Don't process these regions, by name or pattern", nargs='+')
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
-    parser.add_argument("--outfile", help="Save the list of Instances to this file", default="amis-to-delete.csv")
+    parser.add_argument("--outfile", help="Save the list of Instances to this file (.csv, .jsonl.gz or .parquet)", default="amis-to-delete.csv")
     parser.add_argument("--older-than-days", help="Only return AMIs older than X days", default=365)
+    parser.add_argument("--include-in-use", help="List AMIs still used by an instance or launch template too", action='store_true')
+    parser.add_argument("--tag-include", help="Only list resources with this tag, as key=value or just key. Repeat to require more tags", action='append')
+    parser.add_argument("--tag-exclude", help="Don't list resources with this tag, as key=value or just key. Repeatable", action='append')
+    parser.add_argument("--max-workers", help="Scan up to this many regions in parallel", type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument("--cache-ttl", help="Reuse describe results cached in the last N seconds, and cache new ones (0 disables the cache)", type=int, default=0)
+    parser.add_argument("--cache-file", help="SQLite file for --cache-ttl and --regions-ttl", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--regions-ttl", help="Keep the account's list of enabled regions in --cache-file and reuse it for N seconds, like 86400 (the default, 0, looks them up every run)",
+                        type=int, default=DEFAULT_REGIONS_TTL)
+    parser.add_argument("--accounts", help="Scan these accounts, by assuming --role-name in each one", nargs='+')
+    parser.add_argument("--accounts-file", help="Scan the accounts listed one per line in this file, by assuming --role-name in each one")
+    parser.add_argument("--role-name", help="Role to assume in each account", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--max-processes", help="Scan up to this many accounts in parallel", type=int, default=DEFAULT_MAX_PROCESSES)
+    parser.add_argument("--metrics-file", help="When done, write the API calls and time spent in each phase to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
 
     args = parser.parse_args()
 
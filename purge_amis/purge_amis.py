@@ -25,62 +25,151 @@ import os
 import re
 import sys
 
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower.accounts import DEFAULT_ROLE_NAME, account_session
+from flamethrower.clients import ClientPool
+from flamethrower.journal import open_journal
+from flamethrower.metrics import metrics
+from flamethrower.readers import read_rows
+from flamethrower.scan import batched
+from flamethrower.throttle import controller
+from flamethrower.workers import DEFAULT_WORKERS_PER_REGION, RegionWorkers
 
-def main(args, logger):
-    # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-    else:
-        session = boto3.Session()
+# How many AMIs to look up in one describe_images call
+DESCRIBE_BATCH_SIZE = 200
 
-    size_deleted = 0
+# How many times, and starting how many seconds apart, to retry deleting a snapshot whose AMI was just deregistered
+IN_USE_RETRIES = 5
+IN_USE_RETRY_DELAY = 2
 
-    # Read the worklist from the passed in CSV file
-    with open(args.infile, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for a in reader:
-            # Create a boto client in the correct region
-            ec2_client = session.client("ec2", region_name=a['Region'])
-            size = delete_ami_and_snapshot(ec2_client, a)
-            if size != False:  # delete_ami_and_snapshot() returns false on any errors
-                logger.info(f"Deleting {a['ImageId']} ({a['Name']}) in {a['Region']} saves {size}GB")
-                size_deleted += size
+
+def main(args, logger):
+    metrics.write_at_exit(args.metrics_file, args.metrics_textfile)
+
+    clients = ClientPool(account_session(args.profile), role_name=args.role_name)
+
+    # Deregistrations are journaled too, with the snapshots they freed up
+    journal = open_journal(args, logger)
+
+    # Stage two deletes the snapshots freed up by stage one, which deregisters the AMIs. Both run per region, and
+    # per account for a multi-account CSV, so work is keyed by where = (Region, AccountId)
+    snapshot_workers = RegionWorkers(lambda where, snap: delete_snapshot(clients.client("ec2", *where), args, *snap, journal), args.workers_per_region)
+    ami_workers = RegionWorkers(lambda where, plan: deregister_ami(clients.client("ec2", *where), args, *plan, snapshot_workers, journal), args.workers_per_region)
+
+    # Read the worklist from the passed in file, grouped by where so each region's AMIs can be looked up together
+    worklist = {}
+    for a in read_rows(args.infile):
+        if a.get('InUse') == "True":
+            logger.warning(f"AMI {a['ImageId']} ({a['Name']}) is used by an instance or launch template. Skipping")
+            continue
+        if journal and journal.done(ami_key(a['Region'], a['ImageId'])):
+            # Already deregistered, so describe_images won't find it. Its snapshots are in the journal though
+            for snapshot_id, size in journal.entries[ami_key(a['Region'], a['ImageId'])]['snapshots']:
+                if not journal.done(snapshot_key(a['Region'], snapshot_id)):
+                    snapshot_workers.submit((a['Region'], a.get('AccountId')), (snapshot_id, size))
+            continue
+        worklist.setdefault((a['Region'], a.get('AccountId')), []).append(a)
+
+    for where, amis in worklist.items():
+        for plan in resolve_amis(clients.client("ec2", *where), amis):
+            ami_workers.submit(where, plan)
+
+    # Every deregistration has to finish before we know the last of the snapshots has been queued
+    ami_workers.join()
+    size_deleted = snapshot_workers.join()
+    if journal:
+        journal.close()
 
     if args.actually_do_it:
         logger.info(f"Deleted {size_deleted}GB of Snapshots")
     else:
         logger.info(f"Would delete {size_deleted}GB of Snapshots")
+    if journal and journal.resumed:
+        logger.info(f"The run being resumed already deleted {journal.resumed_total('size')}GB of Snapshots")
 
+    # Let them know if AWS slowed us down
+    controller.log_summary(logger)
 
-def delete_ami_and_snapshot(client, ami):
-    try:
-        response = client.describe_images(ImageIds=[ami['ImageId']])
-        ami_data = response['Images'][0]
-    except ClientError as e:
-        if e.response['Error']['Code'] == "InvalidAMIID.NotFound":
-            logger.error(f"Unable to locate {ami['ImageId']} - {e}")
-            return(False)
-        else:
-            raise
 
-    snaps_to_delete = []
-    size_to_delete = 0
-    for device in ami_data['BlockDeviceMappings']:
-        if 'Ebs' in device and 'SnapshotId' in device['Ebs']:
-            snaps_to_delete.append(device['Ebs']['SnapshotId'])
-            size_to_delete += device['Ebs']['VolumeSize']
+def resolve_amis(client, amis):
+    '''Look up a region's AMIs DESCRIBE_BATCH_SIZE at a time, and return (ami, snaps_to_delete) for each one found
 
+    snaps_to_delete is a list of (SnapshotId, VolumeSize)
+    '''
+    output = []
+    for batch in batched(amis, DESCRIBE_BATCH_SIZE):
+        # Filtering on image-id (rather than passing ImageIds) just leaves out any AMIs that no longer exist
+        response = client.describe_images(Filters=[{'Name': 'image-id', 'Values': [a['ImageId'] for a in batch]}])
+        images = {i['ImageId']: i for i in response['Images']}
+        for ami in batch:
+            if ami['ImageId'] not in images:
+                logger.error(f"Unable to locate {ami['ImageId']}")
+                continue
+
+            snaps_to_delete = []
+            for device in images[ami['ImageId']]['BlockDeviceMappings']:
+                if 'Ebs' in device and 'SnapshotId' in device['Ebs']:
+                    snaps_to_delete.append((device['Ebs']['SnapshotId'], device['Ebs']['VolumeSize']))
+            output.append((ami, snaps_to_delete))
+    return(output)
+
+
+def ami_key(region, image_id):
+    '''Name an AMI in the journal'''
+    return(f"AMI:{region}:{image_id}")
+
+
+def snapshot_key(region, snapshot_id):
+    '''Name a snapshot in the journal'''
+    return(f"EBS:{region}:{snapshot_id}")
+
+
+def deregister_ami(client, args, ami, snaps_to_delete, snapshot_workers, journal=None):
+    '''Deregister the AMI, then hand its snapshots to the snapshot workers'''
+    size = sum(size for snapshot_id, size in snaps_to_delete)
     if args.actually_do_it:
         logger.info(f"Deregistering AMI {ami['ImageId']}")
         client.deregister_image(ImageId=ami['ImageId'])
-        for s in snaps_to_delete:
-            logger.info(f"Deleting Snapshot {s}")
-            client.delete_snapshot(SnapshotId=s)
+        if journal:
+            # Once it's deregistered this is the only record of which snapshots were its
+            journal.record(ami_key(ami['Region'], ami['ImageId']), snapshots=snaps_to_delete)
     else:
         logger.info(f"Would Deregister AMI {ami['ImageId']}")
-        logger.info(f"Would delete {snaps_to_delete} snapshots once AMI is deleted")
-
-    return(size_to_delete)
+    logger.info(f"Deleting {ami['ImageId']} ({ami['Name']}) in {ami['Region']} saves {size}GB")
+    for snap in snaps_to_delete:
+        snapshot_workers.submit((ami['Region'], ami.get('AccountId')), snap)
+
+
+def delete_snapshot(client, args, snapshot_id, size, journal=None):
+    '''Delete a snapshot freed up by deregistering its AMI, and return the GB deleted'''
+    if not args.actually_do_it:
+        logger.info(f"Would delete Snapshot {snapshot_id} once AMI is deleted")
+        return(size)
+
+    # EC2 can take a moment to notice the AMI using a snapshot is gone
+    for attempt in range(IN_USE_RETRIES + 1):
+        try:
+            logger.info(f"Deleting Snapshot {snapshot_id}")
+            client.delete_snapshot(SnapshotId=snapshot_id)
+            if journal:
+                journal.record(snapshot_key(client.meta.region_name, snapshot_id), size=size)
+            return(size)
+        except ClientError as e:
+            if e.response['Error']['Code'] == "InvalidSnapshot.InUse" and attempt < IN_USE_RETRIES:
+                logger.debug(f"Snapshot {snapshot_id} is still in use, retrying")
+                sleep(IN_USE_RETRY_DELAY * 2 ** attempt)
+            elif e.response['Error']['Code'] == "InvalidSnapshot.InUse":
+                logger.error(f"Unable to delete {snapshot_id} - {e}")
+                return(0)
+            elif e.response['Error']['Code'] == "InvalidSnapshot.NotFound":
+                logger.error(f"Unable to find {snapshot_id}")
+                if journal:
+                    # Nothing left to do for it on a resume either
+                    journal.record(snapshot_key(client.meta.region_name, snapshot_id), size=0)
+                return(0)
+            else:
+                raise
 
 
 def do_args():
@@ -91,7 +180,14 @@ def do_args():
     parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the snapshot and deletion", action='store_true')
-    parser.add_argument("--infile", help="CSV File of images to deregister and delete associated snapshots", required=True)
+    parser.add_argument("--infile", help="CSV File of images to deregister and delete associated snapshots (or the .jsonl.gz or .parquet version)", required=True)
+    parser.add_argument("--role-name", help="Role to assume in the account named by each row's AccountId, if it has one", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--metrics-file", help="When done, write the API calls made to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
+    parser.add_argument("--resume", help="Skip the AMIs and snapshots the journal says an earlier run already deleted", action='store_true')
+    parser.add_argument("--restart", help="Start the journal over, forgetting the AMIs and snapshots an earlier run deleted", action='store_true')
+    parser.add_argument("--journal", help="Journal of deleted AMIs and snapshots (default: INFILE.journal)")
+    parser.add_argument("--workers-per-region", help="Number of AMIs, and of snapshots, to delete at once in each region", type=int, default=DEFAULT_WORKERS_PER_REGION)
 
     args = parser.parse_args()
 
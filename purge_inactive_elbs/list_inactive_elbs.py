@@ -25,100 +25,22 @@ import os
 import re
 import sys
 
-
-
-HEADER=["LoadBalancerName", "Region", "DNSName", "CanonicalHostedZoneName", "CreatedTime", "Scheme", "ListensOn"]
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower.accounts import DEFAULT_MAX_PROCESSES, DEFAULT_ROLE_NAME
+from flamethrower.cache import DEFAULT_CACHE_FILE
+from flamethrower.collectors import ELB_HEADER, ELB_TYPES, inactive_elbs
+from flamethrower.listing import list_resources
+from flamethrower.regions import DEFAULT_REGIONS_TTL
+from flamethrower.scan import DEFAULT_MAX_WORKERS
 
 
 def main(args, logger):
     '''Executes the Primary Logic of the Fast Fix'''
 
-    # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-    else:
-        session = boto3.Session()
-
-    elbs = []  # array of rows to pass to DictWriter
-    tag_keys = ["tag.Name"]  # We need to pass all the tag keys to the DictWriter
-
-    # Get all the Regions for this account
-    for region in get_regions(session, args):
-        client = session.client("elb", region_name=region)
-
-        elb_list = list_elbs(client, region, args)
-        logger.info(f"Found {len(elb_list)} load balancers to cleanup in {region}")
-        for s in elb_list:
-            s['Region'] = region
-            # parse the annoying way AWS returns tags into a proper dict
-            tags = get_elb_tags(client, s['LoadBalancerName'])
-            for key, value in tags.items():
-                # we need to capture the list of tag_keys for Dictwriter, but we prepend with "tag." to avoid
-                # overriding an instance key
-                if f"tag.{key}" not in tag_keys:
-                    tag_keys.append(f"tag.{key}")
-                s[f"tag.{key}"] = value  # now add to the instance dict
-            s['ListensOn'] = ""
-            for l in s['ListenerDescriptions']:
-                s['ListensOn'] += f"{l['Listener']['LoadBalancerPort']} "
-
-
-            elbs.append(s)
-
-    # Now write the final CSV file
-    with open(args.outfile, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=HEADER + tag_keys, extrasaction='ignore')
-        writer.writeheader()
-        for e in elbs:
-            writer.writerow(e)
-
+    list_resources(args, logger, inactive_elbs, ELB_HEADER, "load balancers")
     exit(0)
 
-def get_elb_tags(client, LoadBalancerName):
-    output = {}
-    response = client.describe_tags(LoadBalancerNames=[LoadBalancerName])
-    # Weird response syntax - https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/elb.html#ElasticLoadBalancing.Client.describe_tags
-    for td in response['TagDescriptions']:
-        for t in td['Tags']:
-            output[t['Key']] = t['Value']
-    return(output)
-
-
-def list_elbs(client, region, args):
-    output = []
-    response = client.describe_load_balancers(PageSize=400)
-    for elb in response['LoadBalancerDescriptions']:
-        if not elb['Instances']:
-            output.append(elb)
-    return(output)
-
-
-def parse_tags(tagset):
-    output = {}
-    for t in tagset:
-        output[t['Key']] = t['Value']
-    return(output)
-
-
-def get_regions(session, args):
-    '''Return a list of regions with us-east-1 first. If --region was specified, return a list wth just that'''
-
-    # If we specifed a region on the CLI, return a list of just that
-    if args.region:
-        return([args.region])
-
-    # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2', region_name="us-east-1")
-    response = ec2.describe_regions()
-    output = ['us-east-1']
-    for r in response['Regions']:
-        # return us-east-1 first, but dont return it twice
-        if r['RegionName'] == "us-east-1":
-            continue
-        output.append(r['RegionName'])
-    return(output)
-
-
 def do_args():
     import argparse
     parser = argparse.ArgumentParser()
@@ -126,8 +48,27 @@ def do_args():
     parser.add_argument("--error", help="print error info only", action='store_true')
     parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
     parser.add_argument("--region", help="Only Process Specified Region")
+    parser.add_argument("--regions", help="Only process these regions. Patterns like eu-* pick from the enabled regions", nargs='+')
+    parser.add_argument("--exclude-regions", help="Don't process these regions, by name or pattern", nargs='+')
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
-    parser.add_argument("--outfile", help="Save the list of Instances to this file", default="orphaned-elbs.csv")
+    parser.add_argument("--outfile", help="Save the list of Instances to this file (.csv, .jsonl.gz or .parquet)", default="orphaned-elbs.csv")
+    parser.add_argument("--elb-types", help="Kinds of load balancer to look at (default: all of them)", nargs='+', choices=ELB_TYPES, default=ELB_TYPES)
+    parser.add_argument("--idle-days", help="Also list load balancers with something registered, but too little traffic in the last N days", type=int, default=0)
+    parser.add_argument("--idle-max-requests", help="With --idle-days, most requests a classic or application load balancer can have had and be idle", type=float, default=0)
+    parser.add_argument("--idle-max-bytes", help="With --idle-days, most bytes a network or gateway load balancer can have processed and be idle", type=float, default=0)
+    parser.add_argument("--tag-include", help="Only list resources with this tag, as key=value or just key. Repeat to require more tags", action='append')
+    parser.add_argument("--tag-exclude", help="Don't list resources with this tag, as key=value or just key. Repeatable", action='append')
+    parser.add_argument("--max-workers", help="Scan up to this many regions in parallel", type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument("--cache-ttl", help="Reuse describe results cached in the last N seconds, and cache new ones (0 disables the cache)", type=int, default=0)
+    parser.add_argument("--cache-file", help="SQLite file for --cache-ttl and --regions-ttl", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--regions-ttl", help="Keep the account's list of enabled regions in --cache-file and reuse it for N seconds, like 86400 (the default, 0, looks them up every run)",
+                        type=int, default=DEFAULT_REGIONS_TTL)
+    parser.add_argument("--accounts", help="Scan these accounts, by assuming --role-name in each one", nargs='+')
+    parser.add_argument("--accounts-file", help="Scan the accounts listed one per line in this file, by assuming --role-name in each one")
+    parser.add_argument("--role-name", help="Role to assume in each account", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--max-processes", help="Scan up to this many accounts in parallel", type=int, default=DEFAULT_MAX_PROCESSES)
+    parser.add_argument("--metrics-file", help="When done, write the API calls and time spent in each phase to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
 
     args = parser.parse_args()
 
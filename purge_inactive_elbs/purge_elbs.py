@@ -25,25 +25,55 @@ import os
 import re
 import sys
 
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower.accounts import DEFAULT_ROLE_NAME, account_session
+from flamethrower.clients import ClientPool
+from flamethrower.journal import open_journal
+from flamethrower.metrics import metrics
+from flamethrower.readers import read_rows
+from flamethrower.throttle import controller
+
 
 def main(args, logger):
-    # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-    else:
-        session = boto3.Session()
+    metrics.write_at_exit(args.metrics_file, args.metrics_textfile)
+
+    clients = ClientPool(account_session(args.profile), role_name=args.role_name)
+
+    journal = open_journal(args, logger)
+
+    # Read the worklist from the passed in file
+    for a in read_rows(args.infile):
+        # Application, network and gateway load balancers have an ARN. Classic ELB names are only unique within an account
+        arn = a.get('LoadBalancerArn')
+        key = f"ELB:{arn}" if arn else f"ELB:{a.get('AccountId') or ''}:{a['Region']}:{a['LoadBalancerName']}"
+        if journal and journal.done(key):
+            logger.debug(f"Already deleted {a['LoadBalancerName']}")
+            continue
+        # Get the boto client for the correct region
+        client = clients.client("elbv2" if arn else "elb", a['Region'], a.get('AccountId'))
+        if args.actually_do_it:
+            try:
+                if arn:
+                    client.delete_load_balancer(LoadBalancerArn=arn)
+                else:
+                    client.delete_load_balancer(LoadBalancerName=a['LoadBalancerName'])
+            except ClientError as e:
+                # Deletion protection is on. It isn't journaled, so a run after it is turned off deletes it
+                if e.response['Error']['Code'] == "OperationNotPermitted":
+                    logger.error(f"Unable to delete {a['LoadBalancerName']} - {e}")
+                    continue
+                raise
+            journal.record(key)
+            logger.info(f"Deleted {a['LoadBalancerName']}")
+        else:
+            logger.info(f"Would Delete {a['LoadBalancerName']}")
+
+    if journal:
+        journal.close()
 
-    # Read the worklist from the passed in CSV file
-    with open(args.infile, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for a in reader:
-            # Create a boto client in the correct region
-            client = session.client("elb", region_name=a['Region'])
-            if args.actually_do_it:
-                client.delete_load_balancer(LoadBalancerName=a['LoadBalancerName'])
-                logger.info(f"Deleted {a['LoadBalancerName']}")
-            else:
-                logger.info(f"Would Delete {a['LoadBalancerName']}")
+    # Let them know if AWS slowed us down
+    controller.log_summary(logger)
 
 
 def do_args():
@@ -54,7 +84,13 @@ def do_args():
     parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the snapshot and deletion", action='store_true')
-    parser.add_argument("--infile", help="CSV File of images to deregister and delete associated snapshots", required=True)
+    parser.add_argument("--infile", help="CSV File of images to deregister and delete associated snapshots (or the .jsonl.gz or .parquet version)", required=True)
+    parser.add_argument("--role-name", help="Role to assume in the account named by each row's AccountId, if it has one", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--metrics-file", help="When done, write the API calls made to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
+    parser.add_argument("--resume", help="Skip the ELBs the journal says an earlier run already deleted", action='store_true')
+    parser.add_argument("--restart", help="Start the journal over, forgetting the ELBs an earlier run deleted", action='store_true')
+    parser.add_argument("--journal", help="Journal of deleted ELBs (default: INFILE.journal)")
 
     args = parser.parse_args()
 
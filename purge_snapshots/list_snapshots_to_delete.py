@@ -25,131 +25,28 @@ import os
 import re
 import sys
 
-import pytz
-utc=pytz.UTC
-
-EBS_HEADER=["SnapshotId", "Type", "Region", "StartTime", "VolumeSize", "State", "Description"]
-RDS_HEADER=["DBSnapshotIdentifier", "Type", "Region", "SnapshotCreateTime", "AllocatedStorage", "Status", "DBInstanceIdentifier"]
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower.accounts import DEFAULT_MAX_PROCESSES, DEFAULT_ROLE_NAME
+from flamethrower.cache import DEFAULT_CACHE_FILE
+from flamethrower.collectors import EBS_HEADER, RDS_HEADER, rds_snapshots, snapshots
+from flamethrower.listing import list_resources
+from flamethrower.regions import DEFAULT_REGIONS_TTL
+from flamethrower.scan import DEFAULT_MAX_WORKERS
 
 
 def main(args, logger):
     '''Executes the Primary Logic of the Fast Fix'''
 
-    # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
+    if args.type == "EBS":
+        list_resources(args, logger, snapshots, EBS_HEADER, "snapshots")
+    elif args.type == "RDS":
+        list_resources(args, logger, rds_snapshots, RDS_HEADER, "snapshots")
     else:
-        session = boto3.Session()
-
-    snapshots = []  # array of rows to pass to DictWriter
-    tag_keys = ["tag.Name"]  # We need to pass all the tag keys to the DictWriter
-
-    # Get all the Regions for this account
-    for region in get_regions(session, args):
-        if args.type == "EBS":
-            snap_list = list_snapshots(session, region, args)
-            logger.info(f"Found {len(snap_list)} snapshots to cleanup in {region}")
-            csv_header = EBS_HEADER
-            for s in snap_list:
-                s['Region'] = region
-                s['Type'] = "EBS"
-                # parse the annoying way AWS returns tags into a proper dict
-                if 'Tags' in s:
-                    tags = parse_tags(s['Tags'])
-                    for key, value in tags.items():
-                        # we need to capture the list of tag_keys for Dictwriter, but we prepend with "tag." to avoid
-                        # overriding an instance key
-                        if f"tag.{key}" not in tag_keys:
-                            tag_keys.append(f"tag.{key}")
-                        s[f"tag.{key}"] = value  # now add to the instance dict
-                snapshots.append(s)
-        elif args.type == "RDS":
-            snap_list = list_rds_snapshots(session, region, args)
-            logger.info(f"Found {len(snap_list)} snapshots to cleanup in {region}")
-            csv_header = RDS_HEADER
-            for s in snap_list:
-                s['Region'] = region
-                s['Type'] = "RDS"
-                # parse the annoying way AWS returns tags into a proper dict
-                tags = parse_tags(s['TagList'])
-                for key, value in tags.items():
-                    # we need to capture the list of tag_keys for Dictwriter, but we prepend with "tag." to avoid
-                    # overriding an instance key
-                    if f"tag.{key}" not in tag_keys:
-                        tag_keys.append(f"tag.{key}")
-                    s[f"tag.{key}"] = value  # now add to the instance dict
-                snapshots.append(s)
-        else:
-            logger.critical(f"Invalid type: {args.type}. Aborting...")
-            exit(1)
-
-    # Now write the final CSV file
-    with open(args.outfile, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=csv_header + tag_keys, extrasaction='ignore')
-        writer.writeheader()
-        for s in snapshots:
-            writer.writerow(s)
+        logger.critical(f"Invalid type: {args.type}. Aborting...")
+        exit(1)
     exit(0)
 
-def list_snapshots(session, region, args):
-    ec2_client = session.client("ec2", region_name=region)
-    output = []
-    response = ec2_client.describe_snapshots(
-        OwnerIds=['self'],
-        MaxResults=1000
-    )
-    threshold_time = utc.localize(dt.datetime.today() - dt.timedelta(days=int(args.older_than_days)))
-    logger.info(f"Looking for Snapshots older than {threshold_time}")
-    for s in response['Snapshots']:
-        if s['StartTime'] < threshold_time:
-            logger.debug(f"Snapshot {s['SnapshotId']} was created {s['StartTime']}, which is older that {threshold_time}")
-            output.append(s)
-
-    return(output)
-
-def list_rds_snapshots(session, region, args):
-    client = session.client("rds", region_name=region)
-    output = []
-    response = client.describe_db_snapshots(
-        MaxRecords=100,
-        SnapshotType='manual'
-    )
-    threshold_time = utc.localize(dt.datetime.today() - dt.timedelta(days=int(args.older_than_days)))
-    logger.info(f"Looking for Snapshots older than {threshold_time}")
-    for s in response['DBSnapshots']:
-        if s['SnapshotCreateTime'] < threshold_time:
-            logger.debug(f"Snapshot {s['DBSnapshotIdentifier']} was created {s['SnapshotCreateTime']}, which is older that {threshold_time}")
-            output.append(s)
-
-    return(output)
-
-
-def parse_tags(tagset):
-    output = {}
-    for t in tagset:
-        output[t['Key']] = t['Value']
-    return(output)
-
-
-def get_regions(session, args):
-    '''Return a list of regions with us-east-1 first. If --region was specified, return a list wth just that'''
-
-    # If we specifed a region on the CLI, return a list of just that
-    if args.region:
-        return([args.region])
-
-    # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2', region_name="us-east-1")
-    response = ec2.describe_regions()
-    output = ['us-east-1']
-    for r in response['Regions']:
-        # return us-east-1 first, but dont return it twice
-        if r['RegionName'] == "us-east-1":
-            continue
-        output.append(r['RegionName'])
-    return(output)
-
-
 def do_args():
     import argparse
     parser = argparse.ArgumentParser()
@@ -157,10 +54,26 @@ def do_args():
     parser.add_argument("--error", help="print error info only", action='store_true')
     parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
     parser.add_argument("--region", help="Only Process Specified Region")
+    parser.add_argument("--regions", help="Only process these regions. Patterns like eu-* pick from the enabled regions", nargs='+')
+    parser.add_argument("--exclude-regions", help="Don't process these regions, by name or pattern", nargs='+')
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
-    parser.add_argument("--outfile", help="Save the list of Instances to this file", default="snapshots-to-delete.csv")
+    parser.add_argument("--outfile", help="Save the list of Instances to this file (.csv, .jsonl.gz or .parquet)", default="snapshots-to-delete.csv")
     parser.add_argument("--older-than-days", help="Only return snapshots older than X days", default=365)
     parser.add_argument("--type", help="Purge EBS or RDS Snapshots", choices=["EBS", "RDS"], default="EBS")
+    parser.add_argument("--include-ami-snapshots", help="List EBS snapshots used by an AMI too, with the AMI in the ImageId column", action='store_true')
+    parser.add_argument("--tag-include", help="Only list resources with this tag, as key=value or just key. Repeat to require more tags", action='append')
+    parser.add_argument("--tag-exclude", help="Don't list resources with this tag, as key=value or just key. Repeatable", action='append')
+    parser.add_argument("--max-workers", help="Scan up to this many regions in parallel", type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument("--cache-ttl", help="Reuse describe results cached in the last N seconds, and cache new ones (0 disables the cache)", type=int, default=0)
+    parser.add_argument("--cache-file", help="SQLite file for --cache-ttl and --regions-ttl", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--regions-ttl", help="Keep the account's list of enabled regions in --cache-file and reuse it for N seconds, like 86400 (the default, 0, looks them up every run)",
+                        type=int, default=DEFAULT_REGIONS_TTL)
+    parser.add_argument("--accounts", help="Scan these accounts, by assuming --role-name in each one", nargs='+')
+    parser.add_argument("--accounts-file", help="Scan the accounts listed one per line in this file, by assuming --role-name in each one")
+    parser.add_argument("--role-name", help="Role to assume in each account", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--max-processes", help="Scan up to this many accounts in parallel", type=int, default=DEFAULT_MAX_PROCESSES)
+    parser.add_argument("--metrics-file", help="When done, write the API calls and time spent in each phase to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
 
     args = parser.parse_args()
 
@@ -25,62 +25,124 @@ import os
 import re
 import sys
 
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower.accounts import DEFAULT_ROLE_NAME, account_session
+from flamethrower.clients import ClientPool
+from flamethrower.journal import open_journal
+from flamethrower.ratelimit import RegionRateLimits
+from flamethrower.metrics import metrics
+from flamethrower.readers import read_rows
+from flamethrower.throttle import controller
+from flamethrower.workers import DEFAULT_WORKERS_PER_REGION, RegionWorkers
+
 
 def main(args, logger):
-    # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-    else:
-        session = boto3.Session()
+    metrics.write_at_exit(args.metrics_file, args.metrics_textfile)
+
+    clients = ClientPool(account_session(args.profile), role_name=args.role_name)
 
     size_deleted = 0
+    skipped = 0
+
+    journal = open_journal(args, logger)
+
+    if args.concurrent:
+        # Each region of each account gets its own workers, and its own rate limit for each service, as AWS
+        # throttles every account separately
+        limits = RegionRateLimits({"ec2": args.deletes_per_second, "rds": args.deletes_per_second})
+        workers = RegionWorkers(lambda where, s: delete_snapshot(clients, args, s, limits, journal), args.workers_per_region)
+
+    # Read the worklist from the passed in file
+    for s in read_rows(args.infile):
+        if s['Type'] not in ["EBS", "RDS"]:
+            logger.error(f"Invalid Type {s['Type']}")
+        elif journal and journal.done(snapshot_key(s)):
+            skipped += 1
+        elif s.get('ImageId'):
+            # list_snapshots_to_delete.py --include-ami-snapshots flags these. Deleting them would just fail
+            logger.warning(f"Snapshot {s['SnapshotId']} is used by {s['ImageId']}. Use purge_amis.py to delete it")
+        elif args.concurrent:
+            workers.submit((s['Region'], s.get('AccountId')), s)
+        else:
+            size_deleted += delete_snapshot(clients, args, s, journal=journal)
 
-    # Read the worklist from the passed in CSV file
-    with open(args.infile, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for s in reader:
-
-            if s['Type'] == "EBS":
-                # Create a boto client in the correct region
-                ec2_client = session.client("ec2", region_name=s['Region'])
-                try:
-                    if args.actually_do_it:
-                        ec2_client.delete_snapshot(SnapshotId=s['SnapshotId'])
-                        logger.info(f"Deleted {s['SnapshotId']} ({s['Description']}) in {s['Region']}")
-                    else:
-                        logger.info(f"Would Delete {s['SnapshotId']} ({s['Description']}) in {s['Region']}")
-                    size_deleted += int(s['VolumeSize'])
-                except ClientError as e:
-                    if e.response['Error']['Code'] == "InvalidSnapshot.InUse":
-                        logger.error(f"Unable to delete {s['SnapshotId']} - {e}")
-                    elif e.response['Error']['Code'] == "InvalidSnapshot.NotFound":
-                        logger.error(f"Unable to find {s['SnapshotId']}")
-                    else:
-                        raise
-            elif s['Type'] == "RDS":
-                # Create a boto client in the correct region
-                client = session.client("rds", region_name=s['Region'])
-                try:
-                    if args.actually_do_it:
-                        client.delete_db_snapshot(DBSnapshotIdentifier=s['DBSnapshotIdentifier'])
-                        logger.info(f"Deleted {s['DBSnapshotIdentifier']} (from: {s['DBInstanceIdentifier']}) in {s['Region']} Created: {s['SnapshotCreateTime']}")
-                    else:
-                        logger.info(f"Would Delete {s['DBSnapshotIdentifier']} (from: {s['DBInstanceIdentifier']}) in {s['Region']} Created: {s['SnapshotCreateTime']}")
-                    size_deleted += int(s['AllocatedStorage'])
-                except ClientError as e:
-                    if e.response['Error']['Code'] == "InvalidSnapshot.InUse":
-                        logger.error(f"Unable to delete {s['DBSnapshotIdentifier']} - {e}")
-                    elif e.response['Error']['Code'] == "InvalidSnapshot.NotFound":
-                        logger.error(f"Unable to find {s['DBSnapshotIdentifier']}")
-                    else:
-                        raise
-            else:
-                logger.error(f"Invalid Type {s['Type']}")
+    if args.concurrent:
+        size_deleted = workers.join()
+    if journal:
+        journal.close()
+    if skipped:
+        logger.info(f"Skipped {skipped} snapshots already deleted by the run being resumed")
 
     if args.actually_do_it:
         logger.info(f"Deleted {size_deleted}GB of Snapshots")
     else:
         logger.info(f"Would delete {size_deleted}GB of Snapshots")
+    if journal and journal.resumed:
+        logger.info(f"The run being resumed already deleted {journal.resumed_total('size')}GB of Snapshots")
+
+    # Let them know if AWS slowed us down
+    controller.log_summary(logger)
+
+
+def snapshot_key(s):
+    '''Name the row s in the journal. RDS snapshot names are only unique within an account'''
+    if s['Type'] == "EBS":
+        return(f"EBS:{s.get('AccountId') or ''}:{s['Region']}:{s['SnapshotId']}")
+    return(f"RDS:{s.get('AccountId') or ''}:{s['Region']}:{s['DBSnapshotIdentifier']}")
+
+
+def delete_snapshot(clients, args, s, limits=None, journal=None):
+    '''Delete the EBS or RDS snapshot in row s, returning the GB deleted (zero if it couldn't be deleted)'''
+    if s['Type'] == "EBS":
+        # Get the boto client for the correct region
+        ec2_client = clients.client("ec2", s['Region'], s.get('AccountId'))
+        try:
+            if args.actually_do_it:
+                if limits:
+                    limits.acquire("ec2", (s['Region'], s.get('AccountId')))
+                ec2_client.delete_snapshot(SnapshotId=s['SnapshotId'])
+                if journal:
+                    journal.record(snapshot_key(s), size=int(s['VolumeSize']))
+                logger.info(f"Deleted {s['SnapshotId']} ({s['Description']}) in {s['Region']}")
+            else:
+                logger.info(f"Would Delete {s['SnapshotId']} ({s['Description']}) in {s['Region']}")
+            return(int(s['VolumeSize']))
+        except ClientError as e:
+            if e.response['Error']['Code'] == "InvalidSnapshot.InUse":
+                logger.error(f"Unable to delete {s['SnapshotId']} - {e}")
+            elif e.response['Error']['Code'] == "InvalidSnapshot.NotFound":
+                logger.error(f"Unable to find {s['SnapshotId']}")
+                if journal:
+                    # Nothing left to do for it on a resume either
+                    journal.record(snapshot_key(s), size=0)
+            else:
+                raise
+    elif s['Type'] == "RDS":
+        # Get the boto client for the correct region
+        client = clients.client("rds", s['Region'], s.get('AccountId'))
+        try:
+            if args.actually_do_it:
+                if limits:
+                    limits.acquire("rds", (s['Region'], s.get('AccountId')))
+                client.delete_db_snapshot(DBSnapshotIdentifier=s['DBSnapshotIdentifier'])
+                if journal:
+                    journal.record(snapshot_key(s), size=int(s['AllocatedStorage']))
+                logger.info(f"Deleted {s['DBSnapshotIdentifier']} (from: {s['DBInstanceIdentifier']}) in {s['Region']} Created: {s['SnapshotCreateTime']}")
+            else:
+                logger.info(f"Would Delete {s['DBSnapshotIdentifier']} (from: {s['DBInstanceIdentifier']}) in {s['Region']} Created: {s['SnapshotCreateTime']}")
+            return(int(s['AllocatedStorage']))
+        except ClientError as e:
+            if e.response['Error']['Code'] == "InvalidSnapshot.InUse":
+                logger.error(f"Unable to delete {s['DBSnapshotIdentifier']} - {e}")
+            elif e.response['Error']['Code'] == "InvalidSnapshot.NotFound":
+                logger.error(f"Unable to find {s['DBSnapshotIdentifier']}")
+                if journal:
+                    # Nothing left to do for it on a resume either
+                    journal.record(snapshot_key(s), size=0)
+            else:
+                raise
+    return(0)
 
 def do_args():
     import argparse
@@ -90,7 +152,16 @@ def do_args():
     parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the snapshot and deletion", action='store_true')
-    parser.add_argument("--infile", help="CSV File of Snapshots to delete", required=True)
+    parser.add_argument("--infile", help="CSV File of Snapshots to delete (or the .jsonl.gz or .parquet version)", required=True)
+    parser.add_argument("--role-name", help="Role to assume in the account named by each row's AccountId, if it has one", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--metrics-file", help="When done, write the API calls made to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
+    parser.add_argument("--concurrent", help="Delete snapshots in every region at once, with several workers per region", action='store_true')
+    parser.add_argument("--workers-per-region", help="Number of deletes to run at once in each region of each account with --concurrent", type=int, default=DEFAULT_WORKERS_PER_REGION)
+    parser.add_argument("--resume", help="Skip the snapshots the journal says an earlier run already deleted", action='store_true')
+    parser.add_argument("--restart", help="Start the journal over, forgetting the snapshots an earlier run deleted", action='store_true')
+    parser.add_argument("--journal", help="Journal of deleted snapshots (default: INFILE.journal)")
+    parser.add_argument("--deletes-per-second", help="Limit deletes in each region of each account to this rate with --concurrent", type=float, default=5)
 
     args = parser.parse_args()
 
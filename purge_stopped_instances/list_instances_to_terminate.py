@@ -25,118 +25,23 @@ import os
 import re
 import sys
 
-HEADER=["InstanceId", "Region", "LaunchTime", "InstanceType", "StateTransitionReason", "DisableApiTermination"]
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower.accounts import DEFAULT_MAX_PROCESSES, DEFAULT_ROLE_NAME
+from flamethrower.cache import DEFAULT_CACHE_FILE
+from flamethrower.collectors import INSTANCE_HEADER, stopped_instances
+from flamethrower.listing import list_resources
+from flamethrower.regions import DEFAULT_REGIONS_TTL
+from flamethrower.scan import DEFAULT_MAX_WORKERS
 
 
 def main(args, logger):
     '''Executes the Primary Logic of the Fast Fix'''
 
-    # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-    else:
-        session = boto3.Session()
-
-    instances = []  # array of rows to pass to DictWriter
-    tag_keys = ["tag.Name"]  # We need to pass all the tag keys to the DictWriter
-
-    # Get all the Regions for this account
-    for region in get_regions(session, args):
-        ec2_client = session.client("ec2", region_name=region)
-
-        instance_list = list_stopped_instances(ec2_client, region, args)
-        logger.info(f"Found {len(instance_list)} stopped instances to cleanup in {region}")
-        for i in instance_list:
-            i['Region'] = region
-            # parse the annoying way AWS returns tags into a proper dict
-            tags = parse_tags(i['Tags'])
-            for key, value in tags.items():
-                # we need to capture the list of tag_keys for Dictwriter, but we prepend with "tag." to avoid
-                # overriding an instance key
-                if f"tag.{key}" not in tag_keys:
-                    tag_keys.append(f"tag.{key}")
-                i[f"tag.{key}"] = value  # now add to the instance dict
-
-            # We now need to get the disableApiTermination attribute which wasn't provided by our describe-instances
-            response = ec2_client.describe_instance_attribute(Attribute='disableApiTermination', InstanceId=i['InstanceId'])
-            i['DisableApiTermination'] = response['DisableApiTermination']['Value']
-
-            instances.append(i)
-
-    # Now write the final CSV file
-    with open(args.outfile, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=HEADER + tag_keys, extrasaction='ignore')
-        writer.writeheader()
-        for i in instances:
-            writer.writerow(i)
-
+    list_resources(args, logger, stopped_instances, INSTANCE_HEADER, "stopped instances")
     exit(0)
 
 
-def list_stopped_instances(ec2_client, region, args):
-    output = []
-    response = ec2_client.describe_instances(
-        Filters=[{'Name': 'instance-state-name', 'Values': ['stopped']}],
-        MaxResults=1000
-    )
-    threshold_time = dt.datetime.today() - dt.timedelta(days=int(args.older_than_days))
-    logger.info(f"Looking for Stopped Instances older than {threshold_time}")
-    for r in response['Reservations']:
-        for i in r['Instances']:
-            # print(json.dumps(i, indent=2, default=str))
-
-            # We only want to process Instances that have been stopped longer than --older-than-days
-            # The only way to know when an instance was stopped is to parse the StateTransitionReason
-            if i['StateTransitionReason'] == "":
-                logger.error(f"Instance {i['InstanceId']} in state {i['State']['Name']} has no StateTransitionReason")
-                continue  # nothing to do here, move along, move along
-
-            # Need to extract a date from string that looks like: "User initiated (2021-01-11 22:52:15 GMT)"
-            # Note: so far the sample set of this string is small, more logic may be needed here
-            try:
-                stopped_date_str = re.search('\((.+?)\)', i['StateTransitionReason']).group(1)
-                # print(stopped_date_str)
-                stopped_date = dt.datetime.strptime(stopped_date_str, '%Y-%m-%d %H:%M:%S %Z')
-                # print(stopped_date)
-
-                # If the stopped date is older than our threshold, return the instance info
-                if stopped_date < threshold_time:
-                    logger.debug(f"Instance {i['InstanceId']} is {i['State']['Name']} for {i['StateTransitionReason']}, which is older that {threshold_time}")
-                    output.append(i)
-            except AttributeError:
-                pass
-
-
-
-    return(output)
-
-
-def parse_tags(tagset):
-    output = {}
-    for t in tagset:
-        output[t['Key']] = t['Value']
-    return(output)
-
-
-def get_regions(session, args):
-    '''Return a list of regions with us-east-1 first. If --region was specified, return a list wth just that'''
-
-    # If we specifed a region on the CLI, return a list of just that
-    if args.region:
-        return([args.region])
-
-    # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2', region_name="us-east-1")
-    response = ec2.describe_regions()
-    output = ['us-east-1']
-    for r in response['Regions']:
-        # return us-east-1 first, but dont return it twice
-        if r['RegionName'] == "us-east-1":
-            continue
-        output.append(r['RegionName'])
-    return(output)
-
-
 def do_args():
     import argparse
     parser = argparse.ArgumentParser()
@@ -144,9 +49,24 @@ def do_args():
     parser.add_argument("--error", help="print error info only", action='store_true')
     parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
     parser.add_argument("--region", help="Only Process Specified Region")
+    parser.add_argument("--regions", help="Only process these regions. Patterns like eu-* pick from the enabled regions", nargs='+')
+    parser.add_argument("--exclude-regions", help="Don't process these regions, by name or pattern", nargs='+')
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
-    parser.add_argument("--outfile", help="Save the list of Instances to this file", default="instances-to-terminate.csv")
+    parser.add_argument("--outfile", help="Save the list of Instances to this file (.csv, .jsonl.gz or .parquet)", default="instances-to-terminate.csv")
     parser.add_argument("--older-than-days", help="Only Snapshot and Terminate Instances that have been stopped more than X days", default=90)
+    parser.add_argument("--tag-include", help="Only list resources with this tag, as key=value or just key. Repeat to require more tags", action='append')
+    parser.add_argument("--tag-exclude", help="Don't list resources with this tag, as key=value or just key. Repeatable", action='append')
+    parser.add_argument("--max-workers", help="Scan up to this many regions in parallel", type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument("--cache-ttl", help="Reuse describe results cached in the last N seconds, and cache new ones (0 disables the cache)", type=int, default=0)
+    parser.add_argument("--cache-file", help="SQLite file for --cache-ttl and --regions-ttl", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--regions-ttl", help="Keep the account's list of enabled regions in --cache-file and reuse it for N seconds, like 86400 (the default, 0, looks them up every run)",
+                        type=int, default=DEFAULT_REGIONS_TTL)
+    parser.add_argument("--accounts", help="Scan these accounts, by assuming --role-name in each one", nargs='+')
+    parser.add_argument("--accounts-file", help="Scan the accounts listed one per line in this file, by assuming --role-name in each one")
+    parser.add_argument("--role-name", help="Role to assume in each account", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--max-processes", help="Scan up to this many accounts in parallel", type=int, default=DEFAULT_MAX_PROCESSES)
+    parser.add_argument("--metrics-file", help="When done, write the API calls and time spent in each phase to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
     # parser.add_argument("--batch-size", help="Process no more than N stopped instances per region", default=10)
 
     args = parser.parse_args()
@@ -15,6 +15,7 @@
 
 
 from botocore.exceptions import ClientError
+from collections import deque
 from time import sleep
 import boto3
 import csv
@@ -25,39 +26,108 @@ import os
 import re
 import sys
 
+# The shared helpers live in the flamethrower package at the top of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flamethrower.accounts import DEFAULT_ROLE_NAME, account_session
+from flamethrower.clients import ClientPool
+from flamethrower.metrics import metrics
+from flamethrower.readers import read_rows
+from flamethrower.snapshots import SnapshotPoller
+from flamethrower.throttle import controller
+
 
 def main(args, logger):
     '''Executes the Primary Logic of the Fast Fix'''
 
-    # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-    else:
-        session = boto3.Session()
-
-    # Read the worklist from the passed in CSV file
-    with open(args.infile, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for i in reader:
-            logger.info(f"Processing {i['InstanceId']} ({i['tag.Name']}) in {i['Region']}")
-
-            # Create a boto client in the correct region
-            ec2_client = session.client("ec2", region_name=i['Region'])
+    metrics.write_at_exit(args.metrics_file, args.metrics_textfile)
+
+    clients = ClientPool(account_session(args.profile), role_name=args.role_name)
+
+    # Read the worklist from the passed in file, and queue it up by where = (Region, AccountId). AccountId is only
+    # set for a multi-account CSV
+    queues = {}
+    for i in read_rows(args.infile):
+        # list_instances_to_terminate.py already looked up termination protection, so don't bother taking
+        # snapshots of an instance we aren't going to be allowed to terminate
+        if is_protected(i) and not args.override_deletion_protection:
+            logger.warning(f"Instance {i['InstanceId']} ({i['tag.Name']}) has instance protection. Unable to proceed")
+            continue
+        queues.setdefault((i['Region'], i.get('AccountId')), deque()).append(i)
+
+    run_pipeline(clients, args, queues)
+
+    # Let them know if AWS slowed us down
+    controller.log_summary(logger)
+
+
+def run_pipeline(clients, args, queues):
+    '''Snapshot and terminate every queued instance, working on many instances in each region at once
+
+    Each instance moves from its region's queue, to in flight once its snapshots have been started, to done
+    once they have completed and it has been terminated. No region has more than --max-in-flight instances
+    waiting on snapshots at a time.
+    '''
+    in_flight = {where: {} for where in queues}  # InstanceId -> (instance, snapshot_ids) per region
+    # One poller per region checks on all of that region's pending snapshots in batched calls
+    pollers = {where: SnapshotPoller(clients.client("ec2", *where)) for where in queues}
+
+    while any(queues.values()) or any(in_flight.values()):
+        for where in queues:
+            ec2_client = clients.client("ec2", *where)
+            start_snapshots(ec2_client, args, queues[where], in_flight[where], pollers[where])
+            pollers[where].poll()
+            finish_completed(ec2_client, args, in_flight[where], pollers[where])
+
+        waits = [p.seconds_until_next_poll() for p in pollers.values()]
+        waits = [w for w in waits if w is not None]
+        if waits:
+            logger.debug(f"Snapshots not ready, sleeping {min(waits):.0f} seconds")
+            sleep(min(waits))
+
+
+def start_snapshots(ec2_client, args, queue, in_flight, poller):
+    '''Start snapshots for queued instances until the region has --max-in-flight instances in flight'''
+    while queue and len(in_flight) < args.max_in_flight:
+        i = queue.popleft()
+        logger.info(f"Processing {i['InstanceId']} ({i['tag.Name']}) in {i['Region']}")
+        try:
+            snapshots = snapshot_instance(ec2_client, args, i)
+        except ClientError as e:
+            if not instance_not_found(e, i):
+                raise
+            continue
+        poller.add(snapshots)
+        in_flight[i['InstanceId']] = (i, [s['SnapshotId'] for s in snapshots])
+
+
+def finish_completed(ec2_client, args, in_flight, poller):
+    '''Terminate every in flight instance whose snapshots have completed'''
+    for instance_id, (i, snapshot_ids) in list(in_flight.items()):
+        state = poller.state(snapshot_ids)  # A dry-run has no snapshots, so is always completed
+        if state == "pending":
+            continue
+        if state == "error":
+            logger.error(f"Snapshots {snapshot_ids} of {i['InstanceId']} ({i['tag.Name']}) failed. Not terminating")
+        else:
             try:
-                snapshot_ids = snapshot_instance(ec2_client, args, i)
-                while not snapshots_creation_completed(ec2_client, snapshot_ids):
-                    logger.debug(f"Snapshots not ready, sleeping 10 seconds")
-                    sleep(10)
                 terminate_stopped_instance(ec2_client, args, i)
             except ClientError as e:
-                if e.response['Error']['Code'] == "InvalidInstanceID.NotFound" or e.response['Error']['Code'] == "InvalidParameterValue":
-                    logger.warning(f"Unable to find Instance ID {i['InstanceId']} ({i['tag.Name']}) - No action taken")
-                else:
+                if not instance_not_found(e, i):
                     raise
+        poller.forget(snapshot_ids)
+        del in_flight[instance_id]
+
+
+def instance_not_found(e, i):
+    '''Log and return True if the ClientError e means instance i no longer exists'''
+    if e.response['Error']['Code'] == "InvalidInstanceID.NotFound" or e.response['Error']['Code'] == "InvalidParameterValue":
+        logger.warning(f"Unable to find Instance ID {i['InstanceId']} ({i['tag.Name']}) - No action taken")
+        return(True)
+    return(False)
 
 
 def snapshot_instance(ec2_client, args, i):
-    '''Snapshot all the volumes attached to instance i'''
+    '''Snapshot all the volumes attached to instance i, and return the new snapshots'''
     output = []
 
     dry_run = not args.actually_do_it
@@ -78,7 +148,7 @@ def snapshot_instance(ec2_client, args, i):
 
         for s in response['Snapshots']:
             logger.info(f"Created Snapshot {s['SnapshotId']} for {s['VolumeId']} - Size {s['VolumeSize']}GB - State: {s['State']}")
-            output.append(s['SnapshotId'])
+            output.append(s)
 
         return(output)
     except ClientError as e:
@@ -89,26 +159,22 @@ def snapshot_instance(ec2_client, args, i):
             raise
 
 
-def snapshots_creation_completed(client, snapshot_list):
-
-    if snapshot_list == []:
-        return(True)  # This is a dry-run
-
-    response = client.describe_snapshots(SnapshotIds=snapshot_list)
-    completed=True
-    for s in response['Snapshots']:
-        if s['State'] != "completed":
-            completed=False
-    return(completed)
+def is_protected(i):
+    '''Return the DisableApiTermination value list_instances_to_terminate.py found for this instance'''
+    return(i.get('DisableApiTermination') == "True")
 
 
 def terminate_stopped_instance(ec2_client, args, i):
 
     if args.actually_do_it:
+        if is_protected(i) and args.override_deletion_protection:
+            logger.info(f"Disabling Instance Termination protection on {i['InstanceId']} ({i['tag.Name']})")
+            ec2_client.modify_instance_attribute(InstanceId=i['InstanceId'], DisableApiTermination={'Value': False })
         logger.info(f"Terminating {i['InstanceId']} ({i['tag.Name']})")
         try:
             response = ec2_client.terminate_instances(InstanceIds=[i['InstanceId']])
         except ClientError as e:
+            # Termination protection may have been turned on since the CSV was generated
             if e.response['Error']['Code'] == "OperationNotPermitted":
                 if args.override_deletion_protection:
                     logger.info(f"Disabling Instance Termination protection on {i['InstanceId']} ({i['tag.Name']})")
@@ -133,7 +199,11 @@ def do_args():
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the snapshot and deletion", action='store_true')
     parser.add_argument("--snapshot-message", help="Append this to the description of the Snapshot.")
-    parser.add_argument("--infile", help="CSV File of instances to Snapshot and Terminate", required=True)
+    parser.add_argument("--infile", help="CSV File of instances to Snapshot and Terminate (or the .jsonl.gz or .parquet version)", required=True)
+    parser.add_argument("--role-name", help="Role to assume in the account named by each row's AccountId, if it has one", default=DEFAULT_ROLE_NAME)
+    parser.add_argument("--metrics-file", help="When done, write the API calls made to this JSON file")
+    parser.add_argument("--metrics-textfile", help="When done, write the same metrics to this Prometheus textfile (for node_exporter)")
+    parser.add_argument("--max-in-flight", help="Wait on snapshots for no more than N instances at a time in each region", type=int, default=10)
     parser.add_argument("--override-deletion-protection", help="Modify the instance's disableApiTermination attribute if necessary to terminate the instance", action='store_true')
 
     args = parser.parse_args()